@@ -1,23 +1,204 @@
-import json
 import os
+import shutil
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import fhir_codec
+from fhir_codec import NDJSONWriter
+from instrumentation import metrics, run_stage
+from reference_graph import bundle_ranges, write_patient_index
+from uuid_mapping_store import write_mapping
 
 base_dir = 'Dataset'
 
 folder_path = os.path.join(base_dir, 'originalFHIRBundles')
 output_folder_path = os.path.join(base_dir, 'mergedPatientsPerResourceType')
-uuid_mapping_file_path = os.path.join(output_folder_path, 'uuid_to_url_mapping.json')
+uuid_mapping_file_path = os.path.join(output_folder_path, 'uuid_to_url_mapping.bin')
+shards_folder_path = os.path.join(output_folder_path, '_shards')
+patient_index_file_path = os.path.join(output_folder_path, 'patient_index.bin')
 
 os.makedirs(output_folder_path, exist_ok=True)
 
 uuid_to_url_mapping = {}
+# (patient ID, {resource_type: (first, last)}) for every bundle, in bundle order, for the patient index
+patient_bundles = []
 
 # Function to generate a new URL reference for a resource
 def generate_new_url(resource_type, counter):
     return f"{resource_type}/{counter}"
 
+# Function to give every resource of a bundle its new URL, recording the UUID mappings.
+# Yields (resource_type, resource, original_uuid) where original_uuid is None for resources without an id.
+def split_bundle(data, resource_counters, uuid_to_url_mapping):
+    for entry in data.get('entry', []):
+        resource = entry.get('resource')
+        if resource:
+            resource_type = resource.get('resourceType')
+            resource_counters[resource_type] += 1
+            new_url = generate_new_url(resource_type, resource_counters[resource_type])
+            original_uuid = None
+            if 'id' in resource:
+                original_uuid = f"urn:uuid:{resource['id']}"
+                uuid_to_url_mapping[original_uuid] = new_url
+
+            resource['id'] = new_url
+            yield resource_type, resource, original_uuid
+
+# Function to list the bundles to process, in the same order as a serial run would visit them
+def list_bundle_files(folder_path, max_patients=2000):
+    bundle_files = []
+    for filename in os.listdir(folder_path):
+        if max_patients is not None and len(bundle_files) >= max_patients:
+            break
+        file_path = os.path.join(folder_path, filename)
+        if os.path.isfile(file_path) and file_path.endswith('.json'):
+            bundle_files.append(file_path)
+    return bundle_files
+
+# Function to parse one bundle, recording the time and bytes read
+def load_bundle(file_path):
+    start = time.perf_counter()
+    data = fhir_codec.load_file(file_path)
+    metrics.add_time('parse', time.perf_counter() - start)
+    metrics.count('bytes_read', os.path.getsize(file_path))
+    return data
+
+# Function to split a bundle into the per-type writers, recording the time and resources.
+# Returns the bundle's patient ID and the counter range it used per resource type.
+def write_bundle_resources(data, resource_counters, uuid_to_url_mapping, open_writer):
+    start = time.perf_counter()
+    counters_before = dict(resource_counters)
+    patient_id = None
+    resources = 0
+    for resource_type, resource, _ in split_bundle(data, resource_counters, uuid_to_url_mapping):
+        open_writer(resource_type).write(resource)
+        if resource_type == 'Patient' and patient_id is None:
+            patient_id = resource['id']
+        resources += 1
+    metrics.add_time('split_and_write', time.perf_counter() - start)
+    metrics.count('resources', resources)
+    return patient_id, bundle_ranges(counters_before, resource_counters)
+
+# Worker: split a contiguous chunk of bundles into its own NDJSON shard with counters starting from 0, and
+# return the UUID mappings, bundle ranges and final counters it produced with the worker's metrics.
+# The chunk-local IDs are shifted to their final values when the shards are merged.
+def split_bundle_chunk(chunk_index, file_paths, shards_folder_path):
+    metrics.reset()
+    shard_folder_path = os.path.join(shards_folder_path, f'chunk-{chunk_index:05d}')
+    os.makedirs(shard_folder_path, exist_ok=True)
+    file_handles = {}
+    resource_counters = defaultdict(int)
+    chunk_mapping = {}
+    chunk_bundles = []
+
+    def open_writer(resource_type):
+        if resource_type not in file_handles:
+            shard_file_path = os.path.join(shard_folder_path, f'{resource_type}.ndjson')
+            file_handles[resource_type] = NDJSONWriter(shard_file_path, 'wb')
+        return file_handles[resource_type]
+
+    try:
+        for file_path in file_paths:
+            chunk_bundles.append(write_bundle_resources(load_bundle(file_path), resource_counters, chunk_mapping, open_writer))
+    finally:
+        for fh in file_handles.values():
+            fh.close()
+            metrics.count('bytes_written', fh.bytes_written)
+
+    return chunk_mapping, chunk_bundles, dict(resource_counters), metrics.snapshot()
+
+# Function to shift a chunk-local URL like "Observation/3" by the counters of the previous chunks
+def shift_url(url, offsets):
+    resource_type, _, counter = url.rpartition('/')
+    return generate_new_url(resource_type, int(counter) + offsets.get(resource_type, 0))
+
+# Function to append a chunk's shard of one resource type to the output, shifting every resource ID by the
+# type's offset. The ID is replaced in the raw line when its `"id":"Type/N"` text occurs exactly once;
+# otherwise the line is parsed, which gives the same bytes.
+def append_shifted_shard(shard_file_path, output_file_path, resource_type, offset):
+    if not offset:
+        with open(shard_file_path, 'rb') as shard_file, open(output_file_path, 'ab') as output_file:
+            shutil.copyfileobj(shard_file, output_file)
+        return
+    counter = 0
+    with open(shard_file_path, 'rb') as shard_file, NDJSONWriter(output_file_path, 'ab') as output_file:
+        for line in shard_file:
+            line = line.rstrip(b'\r\n')
+            counter += 1
+            old_id = f'"id":"{generate_new_url(resource_type, counter)}"'.encode('utf-8')
+            new_id = f'"id":"{generate_new_url(resource_type, counter + offset)}"'.encode('utf-8')
+            if line.count(old_id) == 1:
+                output_file.write_line(line.replace(old_id, new_id))
+            else:
+                resource = fhir_codec.loads(line)
+                resource['id'] = generate_new_url(resource_type, counter + offset)
+                output_file.write(resource)
+
+# Function to process the bundles with a pool of worker processes. IDs are identical to a serial run: every
+# chunk numbers its resources from 0, and when the shards are concatenated in bundle order each chunk's IDs,
+# UUID mappings and bundle ranges are shifted by the counters the previous chunks reached.
+def process_files_parallel(folder_path, output_folder_path, max_patients=2000, workers=None):
+    bundle_files = list_bundle_files(folder_path, max_patients)
+    workers = workers or os.cpu_count() or 1
+    chunk_size = max(1, -(-len(bundle_files) // workers))
+    chunks = [bundle_files[i:i + chunk_size] for i in range(0, len(bundle_files), chunk_size)]
+
+    shutil.rmtree(shards_folder_path, ignore_errors=True)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(split_bundle_chunk, chunk_index, chunk, shards_folder_path)
+                for chunk_index, chunk in enumerate(chunks)
+            ]
+            offsets = defaultdict(int)
+            for chunk_index, (chunk, future) in enumerate(zip(chunks, futures)):
+                chunk_mapping, chunk_bundles, chunk_counters, worker_metrics = future.result()
+                for original_uuid, url in chunk_mapping.items():
+                    uuid_to_url_mapping[original_uuid] = shift_url(url, offsets)
+                for patient_id, ranges in chunk_bundles:
+                    patient_bundles.append((
+                        shift_url(patient_id, offsets) if patient_id is not None else None,
+                        {resource_type: (first + offsets[resource_type], last + offsets[resource_type])
+                         for resource_type, (first, last) in ranges.items()},
+                    ))
+
+                # Merge the shards in chunk order so the output matches a serial run line for line
+                start = time.perf_counter()
+                shard_folder_path = os.path.join(shards_folder_path, f'chunk-{chunk_index:05d}')
+                for shard_filename in sorted(os.listdir(shard_folder_path)):
+                    resource_type = shard_filename[:-len('.ndjson')]
+                    append_shifted_shard(os.path.join(shard_folder_path, shard_filename),
+                                         os.path.join(output_folder_path, shard_filename),
+                                         resource_type, offsets[resource_type])
+                metrics.add_time('merge_shards', time.perf_counter() - start)
+
+                for resource_type, counter in chunk_counters.items():
+                    offsets[resource_type] += counter
+                metrics.merge(worker_metrics)
+                metrics.progress('bundles', len(bundle_files), len(chunk))
+    finally:
+        shutil.rmtree(shards_folder_path, ignore_errors=True)
+        write_mapping(uuid_mapping_file_path, uuid_to_url_mapping)
+        write_patient_index(patient_index_file_path, patient_bundles)
+
+        print(f'Processing completed. Processed {len(bundle_files)} files in {output_folder_path} using {workers} workers.')
+        print(f'UUID to URL mappings saved in {uuid_mapping_file_path}.')
+        print(f'Patient index saved in {patient_index_file_path}.')
+
+# Function to remove the NDJSON files of a previous run, which would otherwise be appended to
+def clear_previous_output(output_folder_path):
+    for filename in os.listdir(output_folder_path):
+        if filename.endswith('.ndjson'):
+            os.remove(os.path.join(output_folder_path, filename))
+
 # Function to process each JSON file and extract resources
-def process_files(folder_path, output_folder_path, max_patients=2000):
+def process_files(folder_path, output_folder_path, max_patients=2000, workers=1):
+    clear_previous_output(output_folder_path)
+    workers = workers or os.cpu_count() or 1
+    if workers != 1:
+        return process_files_parallel(folder_path, output_folder_path, max_patients, workers)
+
     # A dictionary to hold file handles for each resource type
     file_handles = defaultdict(lambda: None)
     # Resource counter for generating unique IDs
@@ -25,47 +206,42 @@ def process_files(folder_path, output_folder_path, max_patients=2000):
 
     processed_patients = 0
 
+    def open_writer(resource_type):
+        if file_handles[resource_type] is None:
+            output_file_path = os.path.join(output_folder_path, f'{resource_type}.ndjson')
+            file_handles[resource_type] = NDJSONWriter(output_file_path, 'ab')
+        return file_handles[resource_type]
+
     try:
         for filename in os.listdir(folder_path):
-            if processed_patients >= max_patients:
+            if max_patients is not None and processed_patients >= max_patients:
                 print(f"Reached the limit of {max_patients} patients.")
                 break
 
             file_path = os.path.join(folder_path, filename)
             
             if os.path.isfile(file_path) and file_path.endswith('.json'):
-                with open(file_path, 'r', encoding='utf-8') as json_file:
-                    data = json.load(json_file)
-                    print(f'Processing file: {filename}')
-
-                    for entry in data.get('entry', []):
-                        resource = entry.get('resource')
-                        if resource:
-                            resource_type = resource.get('resourceType')
-                            resource_counters[resource_type] += 1
-                            new_url = generate_new_url(resource_type, resource_counters[resource_type])
-                            if 'id' in resource:
-                                uuid_to_url_mapping[f"urn:uuid:{resource['id']}"] = new_url
-                            
-                            resource['id'] = new_url
-
-                            output_file_path = os.path.join(output_folder_path, f'{resource_type}.ndjson')
-                            
-                            if file_handles[resource_type] is None:
-                                file_handles[resource_type] = open(output_file_path, 'a', encoding='utf-8')
-                            
-                            print(json.dumps(resource), file=file_handles[resource_type])
-                    
-                    processed_patients += 1
-                    
+                data = load_bundle(file_path)
+                metrics.log(f'Processing file: {filename}')
+
+                patient_bundles.append(write_bundle_resources(data, resource_counters, uuid_to_url_mapping, open_writer))
+
+                processed_patients += 1
+                metrics.progress('bundles')
+                
     finally:
         for resource_type, fh in file_handles.items():
             if fh is not None:
                 fh.close()
-        with open(uuid_mapping_file_path, 'w', encoding='utf-8') as mapping_file:
-            json.dump(uuid_to_url_mapping, mapping_file, indent=2)
+                metrics.count('bytes_written', fh.bytes_written)
+        write_mapping(uuid_mapping_file_path, uuid_to_url_mapping)
+        write_patient_index(patient_index_file_path, patient_bundles)
 
         print(f'Processing completed. Processed {processed_patients} files in {output_folder_path}.')
         print(f'UUID to URL mappings saved in {uuid_mapping_file_path}.')
+        print(f'Patient index saved in {patient_index_file_path}.')
 
-process_files(folder_path, output_folder_path, 2000)
+if __name__ == "__main__":
+    with run_stage('stage1-split'):
+        # workers=1 processes the bundles serially; None uses one worker process per CPU
+        process_files(folder_path, output_folder_path, 2000, workers=None)
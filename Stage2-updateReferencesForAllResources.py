@@ -1,38 +1,181 @@
-import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import fhir_codec
+from fhir_codec import NDJSONWriter
+from instrumentation import metrics, run_stage
+from reference_graph import EdgeCollector
+from uuid_mapping_store import open_mapping
 
 output_folder_path = 'Dataset/mergedPatientsPerResourceType'
-uuid_mapping_file_path = os.path.join(output_folder_path, 'uuid_to_url_mapping.json')
+uuid_mapping_file_path = os.path.join(output_folder_path, 'uuid_to_url_mapping.bin')
+reference_graph_file_path = os.path.join(output_folder_path, 'reference_graph.bin')
+# Lines with up to this many references are rewritten in their raw bytes; longer ones are parsed
+byte_substitution_max_references = 16
 
-with open(uuid_mapping_file_path, 'r', encoding='utf-8') as mapping_file:
-    uuid_to_url_mapping = json.load(mapping_file)
+URN_PREFIX = b'urn:uuid:'
+REFERENCE_MARKER = b'"reference":"urn:uuid:'
 
+# Replaces every "reference": "urn:uuid:..." found in the resource's objects (and in the objects of its lists)
+# by its new URL. Walks with an explicit stack; references that are not strings are left alone.
 def update_references(resource, uuid_to_url_mapping):
-    for key, value in resource.items():
-        if isinstance(value, dict):
-            update_references(value, uuid_to_url_mapping)
-        elif isinstance(value, list):
-            for item in value:
-                if isinstance(item, dict):
-                    update_references(item, uuid_to_url_mapping)
-        elif key == 'reference' and value.startswith('urn:uuid:'):
-            if value in uuid_to_url_mapping:
-                resource[key] = uuid_to_url_mapping[value]
-
-def process_and_update_references(output_folder_path, uuid_to_url_mapping):
+    stack = [resource]
+    while stack:
+        node = stack.pop()
+        for key, value in node.items():
+            value_type = type(value)
+            if value_type is dict:
+                stack.append(value)
+            elif value_type is list:
+                for item in value:
+                    if type(item) is dict:
+                        stack.append(item)
+            elif key == 'reference' and value_type is str and value.startswith('urn:uuid:'):
+                url = uuid_to_url_mapping.get(value)
+                if url is not None:
+                    node[key] = url
+
+# Same rewrite on a compact JSON line without parsing it, for lines where every "urn:uuid:" is the value of a
+# "reference" key. Returns None when the line has to be parsed instead (more than max_references references,
+# a urn:uuid: elsewhere, or an escaped character in a reference).
+def substitute_references(line, uuid_to_url_mapping, max_references=byte_substitution_max_references):
+    references = line.count(REFERENCE_MARKER)
+    if references > max_references or references != line.count(URN_PREFIX):
+        return None
+    parts = []
+    position = 0
+    for _ in range(references):
+        start = line.index(REFERENCE_MARKER, position) + len(REFERENCE_MARKER) - len(URN_PREFIX)
+        end = line.index(b'"', start)
+        value = line[start:end]
+        if b'\\' in value:
+            return None
+        url = uuid_to_url_mapping.get(value.decode('utf-8'))
+        if url is not None:
+            parts.append(line[position:start])
+            parts.append(url.encode('utf-8'))
+            position = end
+    if not parts:
+        return line
+    parts.append(line[position:])
+    return b''.join(parts)
+
+# Rewrites one NDJSON file line by line into a temporary file next to it, then atomically replaces
+# the original, so memory use does not depend on the file size. References are added to edge_collector when given.
+# Lines without urn:uuid: are copied as they are, and lines with a few references are rewritten in place by
+# substitute_references; only the others are parsed and serialized again. Stage 1 writes compact JSON with the
+# same codec, so the output is the same byte for byte as parsing every line. With an edge_collector, the lines
+# holding references are parsed too; lines without urn:uuid: have no reference Stage 2 can resolve, so they are
+# still only copied.
+def update_references_in_file(file_path, uuid_to_url_mapping, edge_collector=None):
+    temp_file_path = file_path + '.tmp'
+    bytes_read = os.path.getsize(file_path)
+    parse_time = rewrite_time = write_time = 0.0
+    resources = copied = substituted = parsed_lines = 0
+    try:
+        with fhir_codec.open_file(file_path, 'rb') as file, NDJSONWriter(temp_file_path) as temp_file:
+            for line in file:
+                line = line.rstrip()
+                if not line:
+                    continue
+                start = time.perf_counter()
+                copy = URN_PREFIX not in line
+                if copy:
+                    rewritten_line = line
+                    copied += 1
+                else:
+                    rewritten_line = substitute_references(line, uuid_to_url_mapping)
+                    substituted += rewritten_line is not None
+                substituted_at = time.perf_counter()
+                resource = None
+                if rewritten_line is None or (edge_collector is not None and not copy):
+                    resource = fhir_codec.loads(line if rewritten_line is None else rewritten_line)
+                    parsed_lines += 1
+                parsed = time.perf_counter()
+                if rewritten_line is None:
+                    update_references(resource, uuid_to_url_mapping)
+                if resource is not None and edge_collector is not None:
+                    edge_collector.add_resource(resource)
+                rewritten = time.perf_counter()
+                temp_file.write_line(rewritten_line if rewritten_line is not None else fhir_codec.dumps(resource))
+                parse_time += parsed - substituted_at
+                rewrite_time += (substituted_at - start) + (rewritten - parsed)
+                write_time += time.perf_counter() - rewritten
+                resources += 1
+        os.replace(temp_file_path, file_path)
+        metrics.add_time('parse', parse_time)
+        metrics.add_time('rewrite', rewrite_time)
+        metrics.add_time('write', write_time)
+        metrics.count('resources', resources)
+        metrics.count('lines_copied', copied)
+        metrics.count('lines_substituted', substituted)
+        metrics.count('lines_parsed', parsed_lines)
+        metrics.count('bytes_read', bytes_read)
+        metrics.count('bytes_written', temp_file.bytes_written)
+    except BaseException:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+    return os.path.basename(file_path)
+
+worker_uuid_to_url_mapping = None
+worker_build_reference_graph = False
+
+def init_worker(uuid_to_url_mapping, build_reference_graph):
+    global worker_uuid_to_url_mapping, worker_build_reference_graph
+    worker_uuid_to_url_mapping = uuid_to_url_mapping
+    worker_build_reference_graph = build_reference_graph
+
+# Returns the worker's metrics and reference edges for the file along with its name
+def update_references_in_file_worker(file_path):
+    metrics.reset()
+    edge_collector = EdgeCollector() if worker_build_reference_graph else None
+    filename = update_references_in_file(file_path, worker_uuid_to_url_mapping, edge_collector)
+    edges = (edge_collector.groups, edge_collector.unresolved) if edge_collector is not None else None
+    return filename, metrics.snapshot(), edges
+
+# Function to save the collected references as reference_graph.bin
+def save_reference_graph(edge_collector, output_folder_path):
+    file_path = os.path.join(output_folder_path, os.path.basename(reference_graph_file_path))
+    with metrics.timer('write_reference_graph'):
+        edge_collector.write(file_path)
+    metrics.count('reference_edges', edge_collector.edge_count())
+    metrics.count('unresolved_references', edge_collector.unresolved)
+    print(f'Reference graph with {edge_collector.edge_count()} edges saved in {file_path}.')
+
+# build_reference_graph=True also records every rewritten reference as an edge in reference_graph.bin. It is
+# off by default: the field of each edge is only known after parsing, so every line holding a reference is
+# parsed and walked, which costs more than the byte-level rewrite and than the original rewrite.
+def process_and_update_references(output_folder_path, uuid_to_url_mapping, workers=1, build_reference_graph=False):
+    file_paths = []
     for filename in os.listdir(output_folder_path):
         file_path = os.path.join(output_folder_path, filename)
         if os.path.isfile(file_path) and file_path.endswith('.ndjson'):
-            updated_resources = []
-            with open(file_path, 'r', encoding='utf-8') as file:
-                for line in file:
-                    resource = json.loads(line)
-                    update_references(resource, uuid_to_url_mapping)
-                    updated_resources.append(resource)
-            
-            with open(file_path, 'w', encoding='utf-8') as file:
-                for resource in updated_resources:
-                    print(json.dumps(resource), file=file)
-            print(f'Updated references in {filename}')
-
-process_and_update_references(output_folder_path, uuid_to_url_mapping)
+            file_paths.append(file_path)
+
+    edge_collector = EdgeCollector() if build_reference_graph else None
+
+    if workers == 1:
+        for file_path in file_paths:
+            filename = update_references_in_file(file_path, uuid_to_url_mapping, edge_collector)
+            metrics.log(f'Updated references in {filename}')
+            metrics.progress('files', len(file_paths))
+    else:
+        # Each worker maps the mapping store once and rewrites whole resource-type files
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(uuid_to_url_mapping, build_reference_graph)) as executor:
+            for filename, worker_metrics, edges in executor.map(update_references_in_file_worker, file_paths):
+                metrics.merge(worker_metrics)
+                if edges is not None:
+                    edge_collector.merge(*edges)
+                metrics.log(f'Updated references in {filename}')
+                metrics.progress('files', len(file_paths))
+
+    if edge_collector is not None:
+        save_reference_graph(edge_collector, output_folder_path)
+
+if __name__ == "__main__":
+    with run_stage('stage2-update-references'), open_mapping(uuid_mapping_file_path) as uuid_to_url_mapping:
+        # workers=1 rewrites the files one after the other; None uses one worker process per CPU.
+        # build_reference_graph=True also writes reference_graph.bin (slower, see above).
+        process_and_update_references(output_folder_path, uuid_to_url_mapping, workers=None, build_reference_graph=False)
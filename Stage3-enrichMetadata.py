@@ -1,279 +1,177 @@
-import json
+import multiprocessing
 import os
-from datetime import datetime
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from collections import defaultdict
 from dotenv import load_dotenv
-from openai import OpenAI
-import base64
 import glob
+import fhir_codec
+from enriched_output import EnrichedResourceWriter, enriched_collection_name, vector_file_suffix
+from embedding_text import compile_embedding_path, prepare_texts
+from embeddings import BatchEmbedder, EmbeddingCache, create_embedding_backend
+from instrumentation import metrics, run_stage
+from resource_config import embeddings_config, search_parameters_config
+from uuid_mapping_store import open_mapping
 
 base_dir = 'Dataset'
 
 input_folder_path = os.path.join(base_dir, 'mergedPatientsPerResourceType')
 enriched_folder_path = os.path.join(base_dir, 'enrichedResources')  
-uuid_mapping_file = os.path.join(input_folder_path, 'uuid_to_url_mapping.json')  
+uuid_mapping_file = os.path.join(input_folder_path, 'uuid_to_url_mapping.bin')  
+embeddings_cache_file = os.path.join(base_dir, 'embeddingsCache', 'embeddings.sqlite')
 
 os.makedirs(enriched_folder_path, exist_ok=True)
 
+# Format of the enriched files: 'ndjson', or compressed 'ndjson.gz' / 'ndjson.zst' (needs the zstandard package).
+# With enriched_vector_side_file = True, embedding vectors go to packed float32 <ResourceType>.vectors.f32 files
+# instead of JSON floats. Stage 4 reads all of these directly.
+enriched_output_format = 'ndjson'
+enriched_vector_side_file = False
+
+# Resources enriched, embedded and written together; memory use depends on this, not on the file size
+enrichment_chunk_size = 1000
+
 load_dotenv()
 openai_api_key = os.getenv('OPENAI_API_KEY')
 
-clientOpenAI = OpenAI(api_key=openai_api_key)
-
-# Define search parameters for each resource type (simplified for demonstration)
-search_parameters_config = {
-"AllergyIntolerance": [
-    {"key": "patient", "attribute": "patient.reference"},
-    {"key": "clinical-status", "attribute": "clinicalStatus.coding[0].code"},
-    {"key": "verification-status", "attribute": "verificationStatus.coding[0].code"},
-    {"key": "code", "attribute": "code.coding[0].code"},
-    {"key": "onset", "attribute": "onsetDateTime"}
-],
-"CarePlan": [
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "date", "attribute": "period.start"},
-    {"key": "category", "attribute": "category[0].coding[0].code"},
-    {"key": "status", "attribute": "status"}
-],
-"CareTeam": [
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "status", "attribute": "status"},
-    {"key": "encounter", "attribute": "encounter.reference"},
-    {"key": "participant", "attribute": "participant.member.reference"}
-],
-"Condition": [
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "clinical-status", "attribute": "clinicalStatus.coding[0].code"},
-    {"key": "code", "attribute": "code.coding[0].code"},
-    {"key": "onset-date", "attribute": "onsetDateTime"}
-],
-"Device": [
-    {"key": "patient", "attribute": "patient.reference"},
-    {"key": "status", "attribute": "status"},
-    {"key": "type", "attribute": "type.coding[0].code"},
-    {"key": "identifier", "attribute": "identifier[0].value"}
-],
-"DiagnosticReport": [
-    {"key": "basedOn", "attribute": "basedOn.reference"},
-    {"key": "category", "attribute": "category.coding[0].code"},
-    {"key": "code", "attribute": "code.coding[0].code"},
-    {"key": "conclusion", "attribute": "conclusion"},
-    {"key": "date", "attribute": "effectiveDateTime"},
-    {"key": "encounter", "attribute": "encounter.reference"},
-    {"key": "identifier", "attribute": "identifier[0].value"},
-    {"key": "issued", "attribute": "issued"},
-    {"key": "media", "attribute": "media[0].link"},
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "performer", "attribute": "performer[0].actor.reference"},
-    {"key": "result", "attribute": "result[0].reference"},
-    {"key": "resultsInterpreter", "attribute": "resultsInterpreter[0].reference"},
-    {"key": "specimen", "attribute": "specimen[0].reference"},
-    {"key": "status", "attribute": "status"},
-    {"key": "study", "attribute": "imagingStudy[0].reference"},
-    {"key": "subject", "attribute": "subject.reference"}
-],
-"DocumentReference": [
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "type", "attribute": "type.coding[0].code"},
-    {"key": "date", "attribute": "date"},
-    {"key": "category", "attribute": "category[0].coding[0].code"}
-],
-"Encounter": [
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "date", "attribute": "period.start"},
-    {"key": "type", "attribute": "type[0].coding[0].code"},
-    {"key": "status", "attribute": "status"}
-],
-"ImagingStudy": [
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "modality", "attribute": "series[0].modality.code"},
-    {"key": "date", "attribute": "started"},
-    {"key": "basedon", "attribute": "basedOn[0].reference"}
-],
-"Immunization": [
-    {"key": "patient", "attribute": "patient.reference"},
-    {"key": "date", "attribute": "occurrenceDateTime"},
-    {"key": "status", "attribute": "status"},
-    {"key": "vaccine-code", "attribute": "vaccineCode.coding[0].code"}
-],
-"Location": [
-    {"key": "name", "attribute": "name"},
-    {"key": "address", "attribute": "address.text"},
-    {"key": "type", "attribute": "type[0].coding[0].code"},
-    {"key": "status", "attribute": "status"}
-],
-"Medication": [
-    {"key": "code", "attribute": "code.coding[0].code"},
-    {"key": "status", "attribute": "status"},
-    {"key": "form", "attribute": "form.coding[0].code"},
-    {"key": "ingredient", "attribute": "ingredient[0].itemCodeableConcept.coding[0].code"}
-],
-"MedicationAdministration": [
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "status", "attribute": "status"},
-    {"key": "effective-time", "attribute": "effectiveDateTime"},
-    {"key": "medication", "attribute": "medicationCodeableConcept.coding[0].code"}
-],
-"MedicationRequest": [
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "status", "attribute": "status"},
-    {"key": "intent", "attribute": "intent"},
-    {"key": "medication", "attribute": "medicationCodeableConcept.coding[0].code"}
-],
-"MedicationStatement": [
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "status", "attribute": "status"},
-    {"key": "effective", "attribute": "effectiveDateTime"},
-    {"key": "medication", "attribute": "medicationCodeableConcept.coding[0].code"}
-],
-"Observation": [
-    {"key": "subject", "attribute": "subject.reference"},
-    {"key": "code", "attribute": "code.coding[0].code"},
-    {"key": "date", "attribute": "effectiveDateTime"},
-    {"key": "status", "attribute": "status"}
-],
-"Organization": [
-    {"key": "name", "attribute": "name"},
-    {"key": "active", "attribute": "active"},
-    {"key": "type", "attribute": "type[0].coding[0].code"},
-    {"key": "address", "attribute": "address[0].text"}
-],
-"Patient": [
-    {"key": "identifier", "attribute": "identifier[0].value"},
-    {"key": "name", "attribute": "name[0].family"},
-    {"key": "family", "attribute": "name[0].family"},
-    {"key": "given", "attribute": "name[0].given[0]"},
-    {"key": "gender", "attribute": "gender"},
-    {"key": "birthdate", "attribute": "birthDate"},
-    {"key": "address", "attribute": "address[0].line[0]"},
-    {"key": "address-city", "attribute": "address[0].city"},
-    {"key": "address-state", "attribute": "address[0].state"},
-    {"key": "address-postalcode", "attribute": "address[0].postalCode"},
-    {"key": "phone", "attribute": "telecom[0].value"},
-    {"key": "email", "attribute": "telecom[1].value"},
-    {"key": "deceased", "attribute": "deceasedBoolean"},
-    {"key": "language", "attribute": "communication[0].language.coding[0].code"}
-],
-"Practitioner": [
-    {"key": "name", "attribute": "name[0].family"},
-    {"key": "identifier", "attribute": "identifier[0].value"},
-    {"key": "address", "attribute": "address[0].line[0]"},
-    {"key": "gender", "attribute": "gender"}
-],
-"PractitionerRole": [
-    {"key": "practitioner", "attribute": "practitioner.reference"},
-    {"key": "organization", "attribute": "organization.reference"},
-    {"key": "role", "attribute": "code[0].coding[0].code"},
-    {"key": "service", "attribute": "healthcareService[0].reference"}
-],
-"Procedure": [
-    {"key": "patient", "attribute": "subject.reference"},
-    {"key": "date", "attribute": "performedDateTime"},
-    {"key": "status", "attribute": "status"},
-    {"key": "code", "attribute": "code.coding[0].code"}
-]
-}
-
-# Add embeddings configuration according to your needs. In this current conf only DiagnosticReport generates them)
-embeddings_config = {
-    "DiagnosticReport": {
-        "path": "presentedForm[].data",
-        "encodedBase64": True,
-        "model": "text-embedding-3-small"
-    },
+# Set EMBEDDINGS_BACKEND=fake to generate deterministic local vectors instead of calling OpenAI (for offline runs and tests)
+embedding_backend = create_embedding_backend(os.getenv('EMBEDDINGS_BACKEND', 'openai'), api_key=openai_api_key)
+
+# Embeddings already computed for the same model and text are reused across runs instead of calling the API again.
+# The cache and the batch embedder are opened on first use, so importing this module does not create the cache file.
+embedding_cache_max_bytes = 2 * 1024 ** 3
+embedding_cache = None
+batch_embedder = None
+
+# Rate limits of your OpenAI account, shared equally by the worker processes
+embedding_requests_per_minute = 3000
+embedding_tokens_per_minute = 1000000
+
+# Embedding requests are batched and sent concurrently, within the rate limits (divided by the number of processes)
+def create_batch_embedder(cache, processes=1):
+    return BatchEmbedder(
+        embedding_backend,
+        batch_size=100,
+        max_workers=4,
+        requests_per_minute=embedding_requests_per_minute / processes,
+        tokens_per_minute=embedding_tokens_per_minute / processes,
+        cache=cache,
+    )
+
+# Opens the embedding cache and its batch embedder if this process has not done it yet
+def open_embedding_cache(processes=1):
+    global embedding_cache, batch_embedder
+    if embedding_cache is None:
+        embedding_cache = EmbeddingCache(embeddings_cache_file, max_bytes=embedding_cache_max_bytes,
+                                         namespace=embedding_backend.cache_namespace)
+        batch_embedder = create_batch_embedder(embedding_cache, processes)
+    return embedding_cache
+
+# Embedding paths compiled once, e.g. "presentedForm[].data" -> ("presentedForm", EACH, "data")
+compiled_embedding_paths = {
+    resource_type: compile_embedding_path(config["path"]) for resource_type, config in embeddings_config.items()
 }
 
-def extract_data_for_embedding(resource, config):
-    #Extracts and decodes data from a resource based on the provided config
-    data = resource
-    for part in config["path"].split('.'):
-        if '[]' in part:
-            part = part.replace('[]', '')
-            data = data.get(part, [])
-            if not isinstance(data, list):
-                return None  # Return None if the expected list structure is not found
-            # If the structure is a list of dictionaries with 'data' fields, proceed to process each element
-            decoded_texts = []
-            for item in data:
-                if config.get("encodedBase64", False):
-                    # Check if item is a dictionary and has a 'data' field
-                    if isinstance(item, dict) and 'data' in item:
-                        try:
-                            # Decode the base64 text within the 'data' field individually
-                            decoded_text = base64.b64decode(item['data']).decode('utf-8')
-                            decoded_texts.append(decoded_text)
-                        except TypeError as e:
-                            print(f"Error decoding base64: {e}")
-                            return None
-                    else:
-                        print(f"Expected a dictionary with a 'data' field but got: {type(item)}")
-                        return None
-                else:
-                    # If not base64 encoded, just append the item (or handle differently if needed)
-                    decoded_texts.append(item)
-            # Join all decoded texts into one string
-            data = " ".join(decoded_texts)
-            break  # Assuming only one list in the path for simplicity
-        else:
-            data = data.get(part, None)
+# Extracts, decodes, normalizes and truncates the embedding texts of a chunk of resources of one type at once
+def prepare_embedding_texts(resourceType, resources):
+    config = embeddings_config.get(resourceType)
+    if not config:
+        return [None] * len(resources)
+    return prepare_texts(resources, config, compiled_embedding_paths[resourceType])
 
-    return data
+def prepare_embedding_text(resourceType, resource):
+    return prepare_embedding_texts(resourceType, [resource])[0]
 
 def get_embedding(resourceType, resource, model="text-embedding-3-small"):
-    config = embeddings_config.get(resourceType)
-    if not config:
-        return None  
-    
-    text = extract_data_for_embedding(resource, config)
+    text = prepare_embedding_text(resourceType, resource)
     if not text:
         return None 
     
+    embedding = open_embedding_cache().get_many([text], model)[0]
+    if embedding is not None:
+        return embedding
+
     try:
-        text = text.replace("\n", " ")
         # Ensure the input is passed as a list
-        response = clientOpenAI.embeddings.create(input=[text], model="text-embedding-3-small")
-        embedding = response['choices'][0]['embedding'] if isinstance(response, dict) else response.data[0].embedding
+        start = time.perf_counter()
+        embedding = embedding_backend.embed([text], model)[0]
+        metrics.observe('embedding_request_latency', time.perf_counter() - start)
+        metrics.count('embedding_requests')
+        embedding_cache.put_many([text], [embedding], model)
     except Exception as e:
         print(f"Failed to get embedding: {e}")
+        metrics.count('embedding_failed_texts')
         embedding = None
 
     return embedding
 
-def extract_search_parameter_values(resource):
-    resource_type = resource.get("resourceType")
-    params_config = search_parameters_config.get(resource_type, [])
+# Fills in the vectors of enriched resources whose embedding was deferred by enrich_resource,
+# sending all their texts through the batch embedder in one go and writing each vector back to its resource
+def fill_embeddings(enriched_resources):
+    deferred = defaultdict(list)  # resourceType -> [(vectorSearchEmbeddings, resource)]
+    for enriched_resource in enriched_resources:
+        embedding = enriched_resource["metadata"].get("vectorSearchEmbeddings")
+        if embedding is None or embedding["vector"] is not None:
+            continue
+        resource = enriched_resource["resource"]
+        deferred[resource.get("resourceType")].append((embedding, resource))
+
+    pending = defaultdict(list)  # model -> [(vectorSearchEmbeddings, text)]
+    for resource_type, items in deferred.items():
+        texts = prepare_embedding_texts(resource_type, [resource for _, resource in items])
+        for (embedding, _), text in zip(items, texts):
+            if text:
+                pending[embedding["model"]].append((embedding, text))
+
+    if pending:
+        open_embedding_cache()
+    for model, items in pending.items():
+        vectors = batch_embedder.embed_all([text for _, text in items], model)
+        for (embedding, _), vector in zip(items, vectors):
+            embedding["vector"] = vector
+
+# Compiles an attribute path such as "category[0].coding[0].code" into the flat lookup steps
+# ("category", 0, "coding", 0, "code"): strings are dict keys and ints are list indexes
+def compile_attribute_path(attribute):
+    steps = []
+    for part in attribute.split('.'):
+        if '[' in part and ']' in part:
+            part, index = part.rstrip(']').split('[')
+            steps.append(part)
+            steps.append(int(index))
+        else:
+            steps.append(part)
+    return tuple(steps)
+
+# Compiles search_parameters_config once into {resourceType: ((key, steps), ...)} so that extracting
+# the values of a resource is only dict and list lookups
+def compile_search_parameters(search_parameters_config):
+    return {
+        resource_type: tuple((param["key"], compile_attribute_path(param["attribute"])) for param in params_config)
+        for resource_type, params_config in search_parameters_config.items()
+    }
+
+compiled_search_parameters = compile_search_parameters(search_parameters_config)
 
+def extract_search_parameter_values(resource):
     extracted_values = []
-    for param in params_config:
-        attribute_path = param["attribute"].split('.')
+    for key, steps in compiled_search_parameters.get(resource.get("resourceType"), ()):
         value = resource
-        for part in attribute_path:
-            # Check if part is attempting to index a list
-            if '[' in part and ']' in part:
-                part, index = part.rstrip(']').split('[')
-                index = int(index)
-                # Ensure value is a dictionary and part exists before accessing it
-                if isinstance(value, dict) and part in value:
-                    value = value.get(part)
-                    # Check if value is a list and has the index
-                    if isinstance(value, list) and len(value) > index:
-                        value = value[index]
-                    else:
-                        value = None
-                else:
-                    value = None
+        for step in steps:
+            if type(step) is int:
+                # Only index lists that are long enough
+                value = value[step] if type(value) is list and len(value) > step else None
             else:
-                # Ensure value is a dictionary before attempting to get part
-                if isinstance(value, dict):
-                    value = value.get(part)
-                else:
-                    value = None
-            
+                # Only look up keys on dictionaries
+                value = value.get(step) if type(value) is dict else None
+
             # Break the loop if value is None at any part
             if value is None:
                 break
 
         if value is not None:
-            extracted_values.append({"key": param["key"], "value": value})
+            extracted_values.append({"key": key, "value": value})
 
     return extracted_values
 
@@ -293,74 +191,205 @@ def extract_data(resource, config):
     return data
 
 def load_and_reverse_uuid_mapping(mapping_file_path):
-    with open(mapping_file_path, 'r') as file:
-        uuid_to_url_mapping = json.load(file)
-    # Reverse the mapping to map from URL (e.g., "CareTeam/12") to UUID
-    url_to_uuid_mapping = {v: k for k, v in uuid_to_url_mapping.items()}
-    return url_to_uuid_mapping
-
-
-def enrich_and_save_resources(input_folder_path, enriched_folder_path, uuid_mapping_file, embeddings_total=25):
-    url_to_uuid_mapping = load_and_reverse_uuid_mapping(uuid_mapping_file)
-    embeddings_counter = {}  # A dictionary to keep count of embeddings per resource type
+    # Reversed view of the mapping store, mapping from URL (e.g., "CareTeam/12") to UUID without loading it into memory
+    return open_mapping(mapping_file_path).reversed()
+
+
+# Metadata shared by every resource of a run, built once per run: lastUpdate is the time the run started
+metadata_template = None
+
+def new_metadata_template():
+    global metadata_template
+    metadata_template = {
+        "documentVersion": "1.0",
+        "fhirVersion": "4.0.1",
+        "lastUpdate": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "tenant_id": "TenantA",
+    }
+    return metadata_template
+
+# Builds the enriched resource from the run's metadata template; only the UUID and the search parameters
+# are computed per resource. With defer_embedding=True the vector is left as None, to be filled in batches
+# by fill_embeddings.
+def build_enriched_resource(resource, uuid, with_embedding, defer_embedding=False):
+    metadata = {
+        **(metadata_template or new_metadata_template()),
+        "uuid": uuid,
+        "searchParameters": extract_search_parameter_values(resource),
+    }
+    if with_embedding:
+        resource_type = resource.get("resourceType")
+        model = embeddings_config[resource_type]["model"]
+        metadata["vectorSearchEmbeddings"] = {
+            "model": model,
+            "vector": None if defer_embedding else get_embedding(resource_type, resource, model)
+        }
+    return {"metadata": metadata, "resource": resource}
+
+# embeddings_total=None removes the per-type limit.
+def enrich_resource(resource, uuid, embeddings_counter, embeddings_total=25, defer_embedding=False):
+    resource_type = resource.get("resourceType")
 
-    # Clear existing enriched files
-    for f in glob.glob(enriched_folder_path + '/enriched_*.ndjson'):
+    # Add embeddings only if the counter for this type is less than the limit
+    with_embedding = resource_type in embeddings_config and (embeddings_total is None or embeddings_counter.get(resource_type, 0) < embeddings_total)
+    if with_embedding:
+        embeddings_counter[resource_type] = embeddings_counter.get(resource_type, 0) + 1
+
+    return build_enriched_resource(resource, uuid, with_embedding, defer_embedding)
+
+class EmbeddingQuota:
+    # Embeddings handed out per resource type, in shared memory so that embeddings_total holds for the whole run
+    # when files are enriched by several worker processes. embeddings_total=None removes the limit.
+    def __init__(self, embeddings_total):
+        self.embeddings_total = embeddings_total
+        self.resource_types = sorted(embeddings_config)
+        self.used = multiprocessing.Array('q', len(self.resource_types))
+
+    # Returns how many of count embeddings of resource_type may still be made
+    def take(self, resource_type, count):
+        if resource_type not in embeddings_config:
+            return 0
+        if self.embeddings_total is None:
+            return count
+        index = self.resource_types.index(resource_type)
+        with self.used.get_lock():
+            granted = max(0, min(count, self.embeddings_total - self.used[index]))
+            self.used[index] += granted
+        return granted
+
+# Enriches a chunk of resources, taking the chunk's embeddings from the quota in one go, so the first resources
+# of each type get them as in a serial run
+def enrich_chunk(resources, url_to_uuid_mapping, embeddings_quota):
+    candidates = defaultdict(int)
+    for resource in resources:
+        candidates[resource.get("resourceType")] += 1
+    granted = {resource_type: embeddings_quota.take(resource_type, count) for resource_type, count in candidates.items()}
+
+    enriched_resources = []
+    for resource in resources:
+        resource_type = resource.get("resourceType")
+        with_embedding = granted[resource_type] > 0
+        if with_embedding:
+            granted[resource_type] -= 1
+        uuid = url_to_uuid_mapping.get(resource.get("id"), "Unknown UUID")
+        enriched_resources.append(build_enriched_resource(resource, uuid, with_embedding, defer_embedding=True))
+    return enriched_resources
+
+# Reads an NDJSON file in chunks of chunk_size resources, recording the parse time
+def read_chunks(file_path, chunk_size):
+    chunk = []
+    start = time.perf_counter()
+    for resource in fhir_codec.iter_ndjson(file_path):
+        chunk.append(resource)
+        if len(chunk) >= chunk_size:
+            metrics.add_time('parse', time.perf_counter() - start)
+            yield chunk
+            chunk = []
+            start = time.perf_counter()
+    metrics.add_time('parse', time.perf_counter() - start)
+    if chunk:
+        yield chunk
+
+# Streams one resource-type file: each chunk is enriched, embedded in batches and written before the next one
+# is read. Returns the path of the enriched file, or None when the file has no resources.
+def enrich_file(file_path, enriched_folder_path, url_to_uuid_mapping, embeddings_quota):
+    resource_type, _ = os.path.splitext(os.path.basename(file_path))
+    file = None
+    try:
+        for resources in read_chunks(file_path, enrichment_chunk_size):
+            with metrics.timer('enrich'):
+                enriched_resources = enrich_chunk(resources, url_to_uuid_mapping, embeddings_quota)
+            with metrics.timer('embed'):
+                fill_embeddings(enriched_resources)
+            with metrics.timer('write'):
+                if file is None:
+                    file = EnrichedResourceWriter(enriched_folder_path, resource_type, enriched_output_format, enriched_vector_side_file)
+                for enriched_resource in enriched_resources:
+                    file.write(enriched_resource)
+            metrics.count('resources', len(enriched_resources))
+    finally:
+        if file is not None:
+            file.close()
+            metrics.count('bytes_written', file.bytes_written)
+    metrics.count('bytes_read', os.path.getsize(file_path))
+    return file.file_path if file is not None else None
+
+
+# Adds the embedding cache's hit, miss and eviction counts to the run report
+def record_cache_stats():
+    for name, value in open_embedding_cache().stats().items():
+        metrics.count(f'embedding_cache_{name}', value)
+
+worker_url_to_uuid_mapping = None
+worker_embeddings_quota = None
+
+# Worker process setup: the parent's quota and metadata template, and an own cache connection and embedder
+def init_worker(uuid_mapping_file, embeddings_quota, template, processes):
+    global worker_url_to_uuid_mapping, worker_embeddings_quota, metadata_template, embedding_cache
+    worker_url_to_uuid_mapping = load_and_reverse_uuid_mapping(uuid_mapping_file)
+    worker_embeddings_quota = embeddings_quota
+    metadata_template = template
+    # Forked workers must not share a cache connection the parent may have opened
+    embedding_cache = None
+    open_embedding_cache(processes)
+
+# Returns the enriched file path with the worker's metrics (cache counts included) for the file
+def enrich_file_worker(file_path, enriched_folder_path):
+    metrics.reset()
+    cache_stats = embedding_cache.stats()
+    enriched_file_path = enrich_file(file_path, enriched_folder_path, worker_url_to_uuid_mapping, worker_embeddings_quota)
+    for name, value in embedding_cache.stats().items():
+        if name != 'bytes':
+            metrics.count(f'embedding_cache_{name}', value - cache_stats[name])
+    return enriched_file_path, metrics.snapshot()
+
+# workers=1 enriches the files one after the other; None uses one worker process per CPU.
+# embeddings_total limits the embeddings per resource type over the whole run, whatever the number of workers.
+def enrich_and_save_resources(input_folder_path, enriched_folder_path, uuid_mapping_file, embeddings_total=25, workers=1):
+    template = new_metadata_template()
+    embeddings_quota = EmbeddingQuota(embeddings_total)
+
+    # Clear existing enriched files, in every output format
+    for f in glob.glob(enriched_folder_path + '/*'):
+        if enriched_collection_name(os.path.basename(f)) is None and not f.endswith(vector_file_suffix):
+            continue
         try:
             os.remove(f)
-            print(f'Removed {f}')
+            metrics.log(f'Removed {f}')
         except OSError as e:
             print(f"Error deleting file {f}: {e.strerror}")
 
-    for filename in os.listdir(input_folder_path):
-        file_path = os.path.join(input_folder_path, filename)
-        if os.path.isfile(file_path) and file_path.endswith('.ndjson'):
-            enriched_resources = []
-
-            with open(file_path, 'r', encoding='utf-8') as file:
-                for line in file:
-                    resource = json.loads(line)
-                    resource_type = resource.get("resourceType")
-
-                    # Initialize counter for this resource type if it doesn't exist
-                    if resource_type not in embeddings_counter:
-                        embeddings_counter[resource_type] = 0
-
-                    search_parameters = extract_search_parameter_values(resource)
-                    uuid = url_to_uuid_mapping.get(resource.get("id"), "Unknown UUID")
-                    
-                    enriched_resource = {
-                        "metadata": {
-                            "documentVersion": "1.0",
-                            "fhirVersion": "4.0.1",
-                            "lastUpdate": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-                            "tenant_id": "TenantA",
-                            "uuid": uuid,
-                            "searchParameters": search_parameters,
-                        },
-                        "resource": resource
-                    }
-
-                    # Add embeddings only if the counter for this type is less than the limit
-                    if resource_type in embeddings_config and embeddings_counter[resource_type] < embeddings_total:
-                        enriched_resource["metadata"]["vectorSearchEmbeddings"] = {
-                            "model": embeddings_config[resource_type]["model"],
-                            "vector": get_embedding(resource_type, resource)
-                        }
-                        embeddings_counter[resource_type] += 1
-
-                    enriched_resources.append(enriched_resource)
-
-            # Write enriched resources to a new file
-            if enriched_resources:
-                enriched_file_path = os.path.join(enriched_folder_path, f'{filename}')
-                with open(enriched_file_path, 'w', encoding='utf-8') as file:
-                    for enriched_resource in enriched_resources:
-                        print(json.dumps(enriched_resource), file=file)
-                print(f'Enriched resources saved in {enriched_file_path}')
-
-
-enrich_and_save_resources(input_folder_path, enriched_folder_path, uuid_mapping_file, embeddings_total=25)
+    file_paths = [os.path.join(input_folder_path, filename) for filename in os.listdir(input_folder_path)
+                  if filename.endswith('.ndjson') and os.path.isfile(os.path.join(input_folder_path, filename))]
+
+    if workers == 1:
+        open_embedding_cache()
+        url_to_uuid_mapping = load_and_reverse_uuid_mapping(uuid_mapping_file)
+        for file_path in file_paths:
+            enriched_file_path = enrich_file(file_path, enriched_folder_path, url_to_uuid_mapping, embeddings_quota)
+            if enriched_file_path:
+                metrics.log(f'Enriched resources saved in {enriched_file_path}')
+            metrics.progress('files', len(file_paths))
+        record_cache_stats()
+        print(f'Embeddings cache: {embedding_cache.stats()}')
+        return
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(uuid_mapping_file, embeddings_quota, template, workers)) as executor:
+        for enriched_file_path, worker_metrics in executor.map(enrich_file_worker, file_paths, [enriched_folder_path] * len(file_paths)):
+            metrics.merge(worker_metrics)
+            if enriched_file_path:
+                metrics.log(f'Enriched resources saved in {enriched_file_path}')
+            metrics.progress('files', len(file_paths))
+    print(f"Embeddings cache: { {name: metrics.counters.get(f'embedding_cache_{name}', 0) for name in ('hits', 'misses', 'evictions')} }")
+
+
+
+if __name__ == "__main__":
+    with run_stage('stage3-enrich'):
+        # workers=1 enriches the files serially; None uses one worker process per CPU
+        enrich_and_save_resources(input_folder_path, enriched_folder_path, uuid_mapping_file, embeddings_total=25, workers=None)
 
 
 
@@ -1,8 +1,19 @@
+import asyncio
+import inspect
 import os
 import json  # Make sure to import the json module
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pymongo
+from pymongo import ASCENDING, InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+from pymongo.operations import SearchIndexModel
 from dotenv import load_dotenv
 import certifi
+from enriched_output import enriched_collection_name, iter_enriched
+from instrumentation import metrics, run_stage
+from resource_config import embeddings_config, search_parameters_config
 
 load_dotenv()
 
@@ -13,33 +24,460 @@ mongodb_connection_string = os.environ.get('MONGODB_CONNECTION_STRING')
 database_name = os.getenv('DATABASE')
 
 data_directory = 'Dataset/enrichedResources'
+checkpoint_directory = 'Dataset/uploadCheckpoints'
+vector_search_indexes_file = 'Dataset/vectorSearchIndexes.json'
+
+# Documents sent per insert_many call, and collections uploaded at the same time over the shared connection pool
+upload_batch_size = 1000
+upload_parallel_collections = 4
+# 'insert' for the initial load, 'upsert' to replace existing documents in incremental reloads
+upload_mode = 'insert'
+# 'threads' uploads each collection in its own thread; 'async' runs one asyncio loader where reader tasks decode
+# batches into a bounded queue and upload_in_flight_writes writer coroutines keep bulk writes in flight
+upload_engine = 'threads'
+upload_in_flight_writes = 8
+# Batches decoded ahead of the writers; readers wait when the queue is full, which bounds memory use
+upload_queue_batches = 16
 
 client = pymongo.MongoClient(mongodb_connection_string)
 db = client[database_name]
 
-def upload_collection(file_path, collection_name):
-    print(f'Starting upload for: {collection_name}')
-    with open(file_path, 'r') as file:
-        # This line now works because the json module is imported
-        data = [json.loads(line) for line in file]
-    collection = db[collection_name]
-    collection.insert_many(data)
-    print(f'Uploaded {len(data)} documents to collection {collection_name}')
-
-def main():
-    total_files = len([name for name in os.listdir(data_directory) if name.endswith('.ndjson')])
+# Reads an enriched file (NDJSON, optionally compressed, with vectors restored from any side-file) in batches of
+# batch_size documents, so memory use does not depend on the file size. Yields (batch, end_offset) where
+# end_offset is the offset in the uncompressed content just after the batch's last line.
+def read_batches(file_path, batch_size, start_offset=0):
+    batch = []
+    offset = start_offset
+    for document, offset in iter_enriched(os.path.dirname(file_path), os.path.basename(file_path), start_offset):
+        batch.append(with_document_id(document))
+        if len(batch) >= batch_size:
+            yield batch, offset
+            batch = []
+    if batch:
+        yield batch, offset
+
+# Gives every document a deterministic _id (its resource id, e.g. "Observation/12"),
+# so uploading the same document twice can never create a duplicate
+def with_document_id(document):
+    resource_id = document.get('resource', {}).get('id')
+    if resource_id is not None:
+        document['_id'] = resource_id
+    return document
+
+# Checkpoints record, per file, the (uncompressed) byte offset up to which every batch has been acknowledged,
+# and whether the whole file is done. The file's size and modification time are stored too, so a regenerated
+# file starts again from 0.
+def checkpoint_path(collection_name):
+    return os.path.join(checkpoint_directory, f'{collection_name}.json')
+
+def load_checkpoint(file_path, collection_name):
+    try:
+        with open(checkpoint_path(collection_name), 'r', encoding='utf-8') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return 0, False
+    stat = os.stat(file_path)
+    if checkpoint.get('size') != stat.st_size or checkpoint.get('mtime') != stat.st_mtime:
+        return 0, False
+    return checkpoint.get('offset', 0), checkpoint.get('complete', False)
+
+def save_checkpoint(file_path, collection_name, offset, complete=False):
+    os.makedirs(checkpoint_directory, exist_ok=True)
+    stat = os.stat(file_path)
+    temp_path = checkpoint_path(collection_name) + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as checkpoint_file:
+        json.dump({'offset': offset, 'complete': complete, 'size': stat.st_size, 'mtime': stat.st_mtime}, checkpoint_file)
+    os.replace(temp_path, checkpoint_path(collection_name))
+
+def upsert_requests(batch):
+    return [ReplaceOne({'_id': document['_id']}, document, upsert=True) if '_id' in document else InsertOne(document)
+            for document in batch]
+
+def bulk_write_error_counts(e):
+    write_errors = e.details.get('writeErrors', [])
+    duplicates = sum(1 for error in write_errors if error.get('code') == 11000)
+    written = e.details.get('nInserted', 0) + e.details.get('nUpserted', 0) + e.details.get('nMatched', 0)
+    return written, duplicates, len(write_errors) - duplicates
+
+# Writes one batch. In 'insert' mode documents that already exist (duplicate _id, e.g. a batch replayed
+# after a crash) are skipped; in 'upsert' mode every document replaces the stored one, for incremental reloads.
+# Returns (written, skipped, failed).
+def write_batch(collection, batch, mode):
+    try:
+        if mode == 'upsert':
+            result = collection.bulk_write(upsert_requests(batch), ordered=False)
+            return result.upserted_count + result.matched_count + result.inserted_count, 0, 0
+        # Unordered, so the server can apply the batch in parallel and one bad document does not stop the rest
+        result = collection.insert_many(batch, ordered=False)
+        return len(result.inserted_ids), 0, 0
+    except BulkWriteError as e:
+        return bulk_write_error_counts(e)
+
+# Raised at the end of an upload where documents failed to be written (other than already existing ones)
+class UploadFailedError(Exception):
+    pass
+
+# Uploads one enriched file in batches, resuming after the last acknowledged batch (checkpoint=False uploads
+# without reading or saving checkpoints). `database` defaults to the configured database and can be any
+# pymongo-compatible database (e.g. a mongomock one in tests). A batch with failed documents is not acknowledged:
+# the checkpoint stays before it and the file is not marked complete, so the next run retries from there (the
+# documents written since are then skipped as duplicates, or replaced in upsert mode).
+# Returns (uploaded, failed).
+def upload_collection(file_path, collection_name, database=None, batch_size=None, mode=None, resume=True, checkpoint=True):
+    database = db if database is None else database
+    batch_size = batch_size or upload_batch_size
+    mode = mode or upload_mode
+    collection = database[collection_name]
+
+    start_offset, complete = load_checkpoint(file_path, collection_name) if resume and checkpoint else (0, False)
+    if complete:
+        print(f'Skipping {collection_name}: already uploaded')
+        return 0, 0
+    if start_offset:
+        metrics.log(f'Resuming upload for: {collection_name} from byte {start_offset}')
+    else:
+        metrics.log(f'Starting upload for: {collection_name}')
+
+    uploaded = 0
+    skipped = 0
+    failed = 0
+    start = read_start = time.perf_counter()
+    end_offset = start_offset
+    for batch, end_offset in read_batches(file_path, batch_size, start_offset):
+        write_start = time.perf_counter()
+        written, duplicates, errors = write_batch(collection, batch, mode)
+        write_end = time.perf_counter()
+        # Time spent reading and parsing the batch, then the round trip to MongoDB
+        metrics.add_time('read', write_start - read_start)
+        metrics.add_time('mongo_write', write_end - write_start)
+        metrics.observe('mongo_batch_latency', write_end - write_start)
+        metrics.count('documents_uploaded', written)
+        uploaded += written
+        skipped += duplicates
+        failed += errors
+        metrics.count('documents_failed', errors)
+        if checkpoint and not failed:
+            save_checkpoint(file_path, collection_name, end_offset)
+        read_start = time.perf_counter()
+    if checkpoint and not failed:
+        save_checkpoint(file_path, collection_name, end_offset, complete=True)
+    metrics.count('bytes_read', end_offset - start_offset)
+    elapsed = time.perf_counter() - start
+    rate = uploaded / elapsed if elapsed > 0 else 0.0
+    print(f'Uploaded {uploaded} documents to collection {collection_name} in {elapsed:.1f}s ({rate:,.0f} docs/s)')
+    if skipped:
+        print(f'{skipped} documents were already in collection {collection_name}')
+    if failed:
+        print(f'{failed} documents failed to upload to collection {collection_name}; they are retried on the next run')
+    return uploaded, failed
+
+# Opens the configured database with an asyncio driver: Motor, or PyMongo's own AsyncMongoClient (pymongo 4.10+).
+# Returns None when neither is installed.
+def open_async_database():
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient
+    except ImportError:
+        try:
+            from pymongo import AsyncMongoClient
+        except ImportError:
+            return None
+        return AsyncMongoClient(mongodb_connection_string)[database_name]
+    return AsyncIOMotorClient(mongodb_connection_string)[database_name]
+
+def is_async_collection(collection):
+    return type(collection).__module__.startswith('motor') or inspect.iscoroutinefunction(getattr(collection, 'insert_many', None))
+
+# write_batch for the async engine. Collections of a synchronous driver (pymongo, mongomock) are written
+# from a thread, so the event loop keeps reading while the batch is on the network.
+async def write_batch_async(collection, batch, mode):
+    if not is_async_collection(collection):
+        return await asyncio.to_thread(write_batch, collection, batch, mode)
+    try:
+        if mode == 'upsert':
+            result = await collection.bulk_write(upsert_requests(batch), ordered=False)
+            return result.upserted_count + result.matched_count + result.inserted_count, 0, 0
+        result = await collection.insert_many(batch, ordered=False)
+        return len(result.inserted_ids), 0, 0
+    except BulkWriteError as e:
+        return bulk_write_error_counts(e)
+
+class CollectionUpload:
+    # Upload state of one file in the async engine. Batches can be acknowledged out of order, so the checkpoint
+    # only advances over the batches that are all acknowledged. It never advances past a batch with failed
+    # documents, and such a file is not marked complete.
+    def __init__(self, file_path, collection_name, start_offset, checkpoint):
+        self.file_path = file_path
+        self.collection_name = collection_name
+        self.start_offset = start_offset
+        self.checkpoint = checkpoint
+        self.acknowledged_offset = start_offset
+        self.acknowledged = {}  # batch sequence -> (end offset, failed documents), for batches done ahead of earlier ones
+        self.end_offset = start_offset
+        self.next_sequence = 0
+        self.batch_count = None  # known once the file is read
+        self.uploaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.checkpoint_blocked = False
+        self.started = time.perf_counter()
+        self.done = asyncio.Event()
+
+    def acknowledge(self, sequence, end_offset, written, duplicates, errors):
+        self.uploaded += written
+        self.skipped += duplicates
+        self.failed += errors
+        metrics.count('documents_failed', errors)
+        self.acknowledged[sequence] = (end_offset, errors)
+        advanced = False
+        while self.next_sequence in self.acknowledged:
+            batch_end_offset, batch_errors = self.acknowledged.pop(self.next_sequence)
+            self.next_sequence += 1
+            self.end_offset = batch_end_offset
+            if batch_errors:
+                self.checkpoint_blocked = True
+            if not self.checkpoint_blocked:
+                self.acknowledged_offset = batch_end_offset
+                advanced = True
+        if advanced and self.checkpoint:
+            save_checkpoint(self.file_path, self.collection_name, self.acknowledged_offset)
+        self.check_done()
+
+    def finish_reading(self, batch_count):
+        self.batch_count = batch_count
+        self.check_done()
+
+    def check_done(self):
+        if self.batch_count is None or self.next_sequence < self.batch_count or self.done.is_set():
+            return
+        if self.checkpoint and not self.checkpoint_blocked:
+            save_checkpoint(self.file_path, self.collection_name, self.acknowledged_offset, complete=True)
+        metrics.count('bytes_read', self.end_offset - self.start_offset)
+        elapsed = time.perf_counter() - self.started
+        rate = self.uploaded / elapsed if elapsed > 0 else 0.0
+        print(f'Uploaded {self.uploaded} documents to collection {self.collection_name} in {elapsed:.1f}s ({rate:,.0f} docs/s)')
+        if self.skipped:
+            print(f'{self.skipped} documents were already in collection {self.collection_name}')
+        if self.failed:
+            print(f'{self.failed} documents failed to upload to collection {self.collection_name}; they are retried on the next run')
+        self.done.set()
+
+# Reader task: decodes the file's batches in a worker thread and queues them, waiting while the queue is full
+async def read_collection(upload, queue, batch_size):
+    batches = read_batches(upload.file_path, batch_size, upload.start_offset)
+    sequence = 0
+    while True:
+        start = time.perf_counter()
+        item = await asyncio.to_thread(next, batches, None)
+        metrics.add_time('read', time.perf_counter() - start)
+        if item is None:
+            break
+        batch, end_offset = item
+        await queue.put((upload, sequence, batch, end_offset))
+        sequence += 1
+    upload.finish_reading(sequence)
+
+# Writer coroutine: takes batches from the queue until cancelled
+async def write_queued_batches(queue, database, mode):
+    while True:
+        upload, sequence, batch, end_offset = await queue.get()
+        write_start = time.perf_counter()
+        written, duplicates, errors = await write_batch_async(database[upload.collection_name], batch, mode)
+        write_end = time.perf_counter()
+        metrics.add_time('mongo_write', write_end - write_start)
+        metrics.observe('mongo_batch_latency', write_end - write_start)
+        metrics.count('documents_uploaded', written)
+        upload.acknowledge(sequence, end_offset, written, duplicates, errors)
+        queue.task_done()
+
+# Async engine: uploads the files with parallel_collections reader tasks feeding one bounded queue, drained by
+# in_flight_writes writer coroutines. Returns (uploaded, failed) document counts.
+async def upload_collections_async(files, database, parallel_collections, mode, resume,
+                                   batch_size=None, in_flight_writes=None, queue_batches=None):
+    batch_size = batch_size or upload_batch_size
+    in_flight_writes = in_flight_writes or upload_in_flight_writes
+    queue = asyncio.Queue(maxsize=queue_batches or upload_queue_batches)
+    reader_slots = asyncio.Semaphore(parallel_collections)
+    # Threads for the readers' decoding and for writes through a synchronous driver
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=in_flight_writes + parallel_collections))
+
+    uploads = []
+    for file_path, collection_name in files:
+        start_offset, complete = load_checkpoint(file_path, collection_name) if resume else (0, False)
+        if complete:
+            print(f'Skipping {collection_name}: already uploaded')
+            metrics.progress('files', len(files))
+            continue
+        uploads.append(CollectionUpload(file_path, collection_name, start_offset, checkpoint=True))
+
+    async def upload_file(upload):
+        async with reader_slots:
+            if upload.start_offset:
+                metrics.log(f'Resuming upload for: {upload.collection_name} from byte {upload.start_offset}')
+            else:
+                metrics.log(f'Starting upload for: {upload.collection_name}')
+            await read_collection(upload, queue, batch_size)
+        await upload.done.wait()
+        metrics.progress('files', len(files))
+        return upload.uploaded, upload.failed
+
+    readers = asyncio.ensure_future(asyncio.gather(*(upload_file(upload) for upload in uploads)))
+    writers = [asyncio.ensure_future(write_queued_batches(queue, database, mode)) for _ in range(in_flight_writes)]
+    try:
+        # Writers only stop by failing, in which case the readers would wait forever
+        await asyncio.wait([readers, *writers], return_when=asyncio.FIRST_COMPLETED)
+        for writer in writers:
+            if writer.done():
+                writer.result()
+        results = readers.result()
+        return sum(uploaded for uploaded, _ in results), sum(failed for _, failed in results)
+    finally:
+        for task in [readers, *writers]:
+            task.cancel()
+        await asyncio.gather(readers, *writers, return_exceptions=True)
+
+# Search parameters that reference the patient get a dedicated index, and so do the ones holding dates
+patient_search_parameter_keys = {'patient', 'subject'}
+date_attribute_pattern = re.compile(r'(date|datetime|start|started|issued)$', re.IGNORECASE)
+
+# Vector sizes of the OpenAI embedding models; set "dimensions" in embeddings_config for other models
+embedding_model_dimensions = {
+    'text-embedding-3-small': 1536,
+    'text-embedding-3-large': 3072,
+    'text-embedding-ada-002': 1536,
+}
+
+# Converts a search parameter attribute such as "performer[0].actor.reference" into the document field
+# path "resource.performer.actor.reference" (MongoDB indexes every element of an array)
+def attribute_field_path(attribute):
+    return 'resource.' + re.sub(r'\[\d+\]', '', attribute)
+
+# Derives the indexes of every collection from search_parameters_config:
+# {collection_name: [index keys, ...]}
+def derive_indexes(search_parameters_config):
+    indexes = {}
+    for resource_type, params_config in search_parameters_config.items():
+        collection_indexes = [
+            # Multikey index answering {"metadata.searchParameters": {"$elemMatch": {"key": ..., "value": ...}}}
+            [('metadata.searchParameters.key', ASCENDING), ('metadata.searchParameters.value', ASCENDING)],
+        ]
+        for param in params_config:
+            last_step = re.sub(r'\[\d+\]', '', param['attribute'].split('.')[-1])
+            if param['key'] in patient_search_parameter_keys or date_attribute_pattern.search(last_step):
+                keys = [(attribute_field_path(param['attribute']), ASCENDING)]
+                if keys not in collection_indexes:
+                    collection_indexes.append(keys)
+        indexes[resource_type] = collection_indexes
+    return indexes
+
+# Derives an Atlas Vector Search index definition for every collection in embeddings_config
+def derive_vector_search_indexes(embeddings_config):
+    definitions = {}
+    for resource_type, config in embeddings_config.items():
+        dimensions = config.get('dimensions') or embedding_model_dimensions.get(config['model'])
+        if dimensions is None:
+            print(f"Unknown vector size for model {config['model']}: set \"dimensions\" in embeddings_config['{resource_type}']")
+            continue
+        definitions[resource_type] = {
+            'name': f'{resource_type}_vector_index',
+            'type': 'vectorSearch',
+            'definition': {
+                'fields': [
+                    {
+                        'type': 'vector',
+                        'path': 'metadata.vectorSearchEmbeddings.vector',
+                        'numDimensions': dimensions,
+                        'similarity': 'cosine',
+                    },
+                    {'type': 'filter', 'path': 'metadata.tenant_id'},
+                ]
+            },
+        }
+    return definitions
+
+# Creates the derived indexes for the uploaded collections. Called once the bulk load has finished,
+# as building indexes over loaded data is much faster than maintaining them during the inserts.
+def create_indexes(collection_names, database=None):
+    database = db if database is None else database
+    indexes = derive_indexes(search_parameters_config)
+    for collection_name in collection_names:
+        for keys in indexes.get(collection_name, []):
+            index_name = database[collection_name].create_index(keys)
+            print(f'Index {index_name} ready on collection {collection_name}')
+
+    vector_search_indexes = derive_vector_search_indexes(embeddings_config)
+    with open(vector_search_indexes_file, 'w', encoding='utf-8') as definitions_file:
+        json.dump(vector_search_indexes, definitions_file, indent=2)
+    print(f'Vector search index definitions saved in {vector_search_indexes_file}')
+
+    for collection_name, index in vector_search_indexes.items():
+        if collection_name not in collection_names:
+            continue
+        collection = database[collection_name]
+        try:
+            if any(existing.get('name') == index['name'] for existing in collection.list_search_indexes()):
+                print(f"Vector search index {index['name']} already exists on collection {collection_name}")
+                continue
+            collection.create_search_index(SearchIndexModel(definition=index['definition'], name=index['name'], type=index['type']))
+            print(f"Vector search index {index['name']} requested on collection {collection_name}")
+        except Exception as e:
+            # Search indexes only exist on Atlas (and not in stand-ins like mongomock); elsewhere the saved definitions can be applied by hand
+            print(f"Could not create vector search index {index['name']} on collection {collection_name}: {e}")
+
+# Set resume=False to ignore the checkpoints of a previous run and upload every file from the start.
+# engine overrides upload_engine; with 'async' and no database given, the upload uses Motor when installed.
+def main(database=None, parallel_collections=None, mode=None, resume=True, engine=None):
+    parallel_collections = parallel_collections or upload_parallel_collections
+    engine = engine or upload_engine
+    # Every enriched file (.ndjson, .ndjson.gz or .ndjson.zst) is one collection; vector side-files are read with them
+    filenames = [name for name in os.listdir(data_directory) if enriched_collection_name(name)]
+    total_files = len(filenames)
     print(f'Total files to process: {total_files}')
-    
+
+    start = time.perf_counter()
+    if engine == 'async':
+        total_documents, failed_documents = asyncio.run(upload_async(filenames, database, parallel_collections, mode, resume))
+    else:
+        total_documents, failed_documents = upload_threaded(filenames, database, parallel_collections, mode, resume)
+
+    create_indexes([enriched_collection_name(filename) for filename in filenames], database)
+
+    elapsed = time.perf_counter() - start
+    rate = total_documents / elapsed if elapsed > 0 else 0.0
+    if failed_documents:
+        raise UploadFailedError(f'{failed_documents} documents failed to upload ({total_documents} uploaded in {elapsed:.1f}s). '
+                                f'Run Stage 4 again to retry them from the last checkpoints.')
+    print(f'All data uploaded successfully: {total_documents} documents in {elapsed:.1f}s ({rate:,.0f} docs/s).')
+
+async def upload_async(filenames, database, parallel_collections, mode, resume):
+    if database is None:
+        database = open_async_database()
+        if database is None:
+            print('Motor is not installed: the async engine writes with pymongo from worker threads')
+            database = db
+    files = [(os.path.join(data_directory, filename), enriched_collection_name(filename)) for filename in filenames]
+    return await upload_collections_async(files, database, parallel_collections, mode or upload_mode, resume)
+
+def upload_threaded(filenames, database, parallel_collections, mode, resume):
+    total_files = len(filenames)
     processed_files = 0
-    for filename in os.listdir(data_directory):
-        if filename.endswith('.ndjson'):
-            collection_name, _ = os.path.splitext(filename)
+    # pymongo clients are thread-safe, so the workers share the client's connection pool
+    with ThreadPoolExecutor(max_workers=parallel_collections) as executor:
+        futures = []
+        for filename in filenames:
+            collection_name = enriched_collection_name(filename)
             file_path = os.path.join(data_directory, filename)
-            upload_collection(file_path, collection_name)
+            futures.append(executor.submit(upload_collection, file_path, collection_name, database, None, mode, resume))
+        total_documents = 0
+        failed_documents = 0
+        for future in futures:
+            uploaded, failed = future.result()
+            total_documents += uploaded
+            failed_documents += failed
             processed_files += 1
-            print(f'Processed {processed_files}/{total_files} files.')
-    
-    print('All data uploaded successfully.')
+            metrics.log(f'Processed {processed_files}/{total_files} files.')
+            metrics.progress('files', total_files)
+    return total_documents, failed_documents
 
 if __name__ == "__main__":
-    main()
+    with run_stage('stage4-upload'):
+        main()
@@ -0,0 +1,111 @@
+import os
+import time
+from collections import defaultdict
+from enriched_output import EnrichedResourceWriter, remove_enriched_files
+from instrumentation import metrics, run_stage
+from stage_modules import load_stage
+from uuid_mapping_store import write_mapping
+
+# Single-pass alternative to running Stage 1, Stage 2 and Stage 3 one after the other: each resource is
+# parsed once (as part of its bundle), has its references rewritten, is enriched and is serialized once
+# straight into Dataset/enrichedResources, without the intermediate mergedPatientsPerResourceType files.
+stage1 = load_stage('Stage1-splitBundlesAndMappingNewReferences.py')
+stage2 = load_stage('Stage2-updateReferencesForAllResources.py')
+stage3 = load_stage('Stage3-enrichMetadata.py')
+
+base_dir = 'Dataset'
+
+folder_path = os.path.join(base_dir, 'originalFHIRBundles')
+enriched_folder_path = os.path.join(base_dir, 'enrichedResources')
+uuid_mapping_file_path = os.path.join(enriched_folder_path, 'uuid_to_url_mapping.bin')
+
+os.makedirs(enriched_folder_path, exist_ok=True)
+
+# Split step: every bundle is pre-scanned so all of its UUIDs are mapped before any of its
+# resources are emitted, which resolves references pointing forward within the bundle
+def split_resources(bundle_files, uuid_to_url_mapping):
+    resource_counters = defaultdict(int)
+    for file_path in bundle_files:
+        data = stage1.load_bundle(file_path)
+        resources = list(stage1.split_bundle(data, resource_counters, uuid_to_url_mapping))
+        metrics.count('resources', len(resources))
+        metrics.progress('bundles', len(bundle_files))
+        yield from resources
+
+# Reference rewrite step (Stage 2)
+def update_references(resources, uuid_to_url_mapping):
+    rewrite_time = 0.0
+    try:
+        for resource_type, resource, original_uuid in resources:
+            start = time.perf_counter()
+            stage2.update_references(resource, uuid_to_url_mapping)
+            rewrite_time += time.perf_counter() - start
+            yield resource_type, resource, original_uuid
+    finally:
+        metrics.add_time('rewrite', rewrite_time)
+
+# Enrichment step (Stage 3); the original UUID is already known, so no reversed mapping is needed.
+# embeddings_counter ({type: embeddings already handed out}) lets a caller continue a quota across runs.
+def enrich_resources(resources, embeddings_total=25, embeddings_counter=None):
+    stage3.new_metadata_template()
+    embeddings_counter = {} if embeddings_counter is None else embeddings_counter
+    enrich_time = 0.0
+    try:
+        for resource_type, resource, original_uuid in resources:
+            uuid = original_uuid or "Unknown UUID"
+            start = time.perf_counter()
+            enriched_resource = stage3.enrich_resource(resource, uuid, embeddings_counter, embeddings_total, defer_embedding=True)
+            enrich_time += time.perf_counter() - start
+            yield resource_type, enriched_resource
+    finally:
+        metrics.add_time('enrich', enrich_time)
+
+# Embedding step: resources are buffered in chunks so their embeddings are requested in batches
+def embed_resources(enriched_resources, chunk_size=1000):
+    chunk = []
+    for item in enriched_resources:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            with metrics.timer('embed'):
+                stage3.fill_embeddings([enriched_resource for _, enriched_resource in chunk])
+            yield from chunk
+            chunk = []
+    with metrics.timer('embed'):
+        stage3.fill_embeddings([enriched_resource for _, enriched_resource in chunk])
+    yield from chunk
+
+def run_fused_pipeline(folder_path, enriched_folder_path, max_patients=2000, embeddings_total=25):
+    bundle_files = stage1.list_bundle_files(folder_path, max_patients)
+    uuid_to_url_mapping = {}
+    file_handles = {}
+    stage3.open_embedding_cache()
+
+    resources = split_resources(bundle_files, uuid_to_url_mapping)
+    resources = update_references(resources, uuid_to_url_mapping)
+    enriched_resources = enrich_resources(resources, embeddings_total)
+    enriched_resources = embed_resources(enriched_resources)
+
+    # Enriched files are written in Stage 3's enriched_output_format, with its vector side-file setting
+    remove_enriched_files(enriched_folder_path)
+    try:
+        for resource_type, enriched_resource in enriched_resources:
+            if resource_type not in file_handles:
+                file_handles[resource_type] = EnrichedResourceWriter(
+                    enriched_folder_path, resource_type, stage3.enriched_output_format, stage3.enriched_vector_side_file)
+            file_handles[resource_type].write(enriched_resource)
+    finally:
+        for fh in file_handles.values():
+            fh.close()
+            metrics.count('bytes_written', fh.bytes_written)
+        # Kept for reference and for tools that still expect the mapping next to the output
+        write_mapping(uuid_mapping_file_path, uuid_to_url_mapping)
+
+    print(f'Processing completed. Processed {len(bundle_files)} files into {enriched_folder_path}.')
+    for resource_type in sorted(file_handles):
+        metrics.log(f'Enriched resources saved in {file_handles[resource_type].file_path}')
+    stage3.record_cache_stats()
+    print(f'Embeddings cache: {stage3.embedding_cache.stats()}')
+
+if __name__ == "__main__":
+    with run_stage('fused-split-update-enrich'):
+        run_fused_pipeline(folder_path, enriched_folder_path, 2000, embeddings_total=25)
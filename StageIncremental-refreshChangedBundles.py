@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+from bisect import bisect_right
+from collections import defaultdict
+import fhir_codec
+from fhir_codec import NDJSONWriter
+from enriched_output import remove_enriched_files
+from instrumentation import metrics, run_stage
+from reference_graph import write_patient_index
+from stage_modules import load_stage
+
+# Incremental alternative to re-running the whole pipeline when new Synthea bundles arrive. A manifest records the
+# content hash of every processed bundle and the ID range assigned to it for each resource type; a rerun only
+# splits, rewrites and enriches the new or changed bundles, and drops the resources of changed or removed bundles.
+# The enriched files it maintains are plain NDJSON with inline vectors, whatever Stage 3's output format. The
+# patient index is rewritten from the manifest, so the enriched files can still be partitioned by patient.
+stage1 = load_stage('Stage1-splitBundlesAndMappingNewReferences.py')
+fused = load_stage('StageFused-splitUpdateAndEnrich.py')
+
+base_dir = 'Dataset'
+
+folder_path = os.path.join(base_dir, 'originalFHIRBundles')
+enriched_folder_path = os.path.join(base_dir, 'enrichedResources')
+delta_folder_path = os.path.join(base_dir, 'incrementalResources')
+manifest_file_path = os.path.join(base_dir, 'pipelineManifest.json')
+patient_index_file_path = os.path.join(base_dir, 'mergedPatientsPerResourceType', 'patient_index.bin')
+
+os.makedirs(enriched_folder_path, exist_ok=True)
+os.makedirs(delta_folder_path, exist_ok=True)
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# The manifest looks like {"counters": {type: last assigned counter},
+#                          "bundles": {filename: {"sha256": ..., "ranges": {type: [first, last]},
+#                                                 "embeddings": {type: embedded resources}}}}.
+# Counters are high-water marks, so IDs of changed or removed bundles are never handed out again. The embeddings
+# of the kept bundles count against embeddings_total, so the limit holds for the enriched files as a whole, as in
+# a full run, instead of every refresh embedding up to embeddings_total more resources.
+def load_manifest(manifest_file_path):
+    if not os.path.exists(manifest_file_path):
+        return None
+    with open(manifest_file_path, 'r', encoding='utf-8') as manifest_file:
+        return json.load(manifest_file)
+
+def save_manifest(manifest_file_path, manifest):
+    temp_file_path = manifest_file_path + '.tmp'
+    with open(temp_file_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(temp_file_path, manifest_file_path)
+
+# Merges the ID ranges of several manifest entries into {type: [(first, last), ...]}
+def collect_ranges(bundle_entries):
+    ranges = defaultdict(list)
+    for bundle_entry in bundle_entries:
+        for resource_type, (first, last) in bundle_entry['ranges'].items():
+            ranges[resource_type].append((first, last))
+    return ranges
+
+# Function to rewrite the patient index from the manifest's bundle ranges. Stage 1 takes the first Patient
+# of a bundle as its owner, which is the first ID of the bundle's Patient range.
+def write_patient_index_from_manifest(patient_index_file_path, manifest_bundles):
+    bundles = []
+    for bundle_entry in manifest_bundles.values():
+        patient_range = bundle_entry['ranges'].get('Patient')
+        patient_id = stage1.generate_new_url('Patient', patient_range[0]) if patient_range else None
+        bundles.append((patient_id, {resource_type: tuple(id_range) for resource_type, id_range in bundle_entry['ranges'].items()}))
+    os.makedirs(os.path.dirname(patient_index_file_path), exist_ok=True)
+    write_patient_index(patient_index_file_path, bundles)
+
+# Function to read the resource ID of an enriched line without parsing it (and its vector). The
+# `"id":"<Type>/` text is looked up in the raw line; the line is only parsed when it is not found exactly once.
+def enriched_resource_id(line, resource_type):
+    prefix = f'"id":"{resource_type}/'.encode('utf-8')
+    start = line.find(prefix)
+    if start != -1 and line.find(prefix, start + 1) == -1:
+        end = line.find(b'"', start + len(prefix))
+        counter = line[start + len(prefix):end]
+        if counter.isdigit():
+            return f'{resource_type}/{counter.decode("ascii")}'
+    metrics.count('lines_parsed')
+    return fhir_codec.loads(line)['resource']['id']
+
+# Function to record in the manifest entries of the delta's bundles how many of their resources were embedded.
+# IDs are handed out bundle by bundle, so per type the bundle ranges are sorted and one bisect finds the bundle.
+def count_bundle_embeddings(embedded_ids, bundle_entries):
+    bundle_ranges = defaultdict(list)  # type -> [(first, last, filename)]
+    for filename, bundle_entry in bundle_entries.items():
+        for resource_type, (first, last) in bundle_entry['ranges'].items():
+            bundle_ranges[resource_type].append((first, last, filename))
+    for ranges in bundle_ranges.values():
+        ranges.sort()
+    for resource_id in embedded_ids:
+        resource_type, _, counter = resource_id.rpartition('/')
+        ranges = bundle_ranges[resource_type]
+        index = bisect_right(ranges, (int(counter), float('inf'))) - 1
+        if index < 0 or not ranges[index][0] <= int(counter) <= ranges[index][1]:
+            continue
+        embeddings = bundle_entries[ranges[index][2]].setdefault('embeddings', {})
+        embeddings[resource_type] = embeddings.get(resource_type, 0) + 1
+
+def in_ranges(resource_id, ranges):
+    resource_type, _, counter = resource_id.rpartition('/')
+    if resource_type not in ranges or not counter.isdigit():
+        return False
+    counter = int(counter)
+    return any(first <= counter <= last for first, last in ranges[resource_type])
+
+# Split step for the new and changed bundles only, continuing from the manifest's counters and
+# recording the range of IDs every bundle receives
+def split_changed_bundles(bundle_files, bundle_hashes, resource_counters, uuid_to_url_mapping, manifest_bundles):
+    for file_path in bundle_files:
+        filename = os.path.basename(file_path)
+        data = stage1.load_bundle(file_path)
+        counters_before = dict(resource_counters)
+        resources = list(stage1.split_bundle(data, resource_counters, uuid_to_url_mapping))
+        manifest_bundles[filename] = {
+            'sha256': bundle_hashes[filename],
+            'ranges': {
+                resource_type: [counters_before.get(resource_type, 0) + 1, counter]
+                for resource_type, counter in resource_counters.items()
+                if counter != counters_before.get(resource_type, 0)
+            },
+        }
+        metrics.log(f'Processing file: {filename}')
+        metrics.count('resources', len(resources))
+        metrics.progress('bundles', len(bundle_files))
+        yield from resources
+
+# Rewrites a full enriched file without the dropped IDs, then appends the delta. Dropping the delta's own
+# IDs as well makes the merge safe to repeat if a previous run stopped before saving the manifest.
+def merge_into_enriched_file(resource_type, dropped_ranges, enriched_folder_path, delta_folder_path):
+    enriched_file_path = os.path.join(enriched_folder_path, f'{resource_type}.ndjson')
+    delta_file_path = os.path.join(delta_folder_path, f'{resource_type}.ndjson')
+    temp_file_path = enriched_file_path + '.tmp'
+    kept = 0
+    with NDJSONWriter(temp_file_path) as temp_file:
+        for source_file_path, filter_ranges in ((enriched_file_path, dropped_ranges), (delta_file_path, None)):
+            if not os.path.exists(source_file_path):
+                continue
+            with open(source_file_path, 'rb') as source_file:
+                for line in source_file:
+                    line = line.rstrip(b'\r\n')
+                    if not line or (filter_ranges and in_ranges(enriched_resource_id(line, resource_type), filter_ranges)):
+                        continue
+                    temp_file.write_line(line)
+                    kept += 1
+    if kept:
+        os.replace(temp_file_path, enriched_file_path)
+    else:
+        os.remove(temp_file_path)
+        if os.path.exists(enriched_file_path):
+            os.remove(enriched_file_path)
+
+# Upserts the delta into MongoDB with Stage 4 and deletes the documents of changed or removed bundles
+def upload_delta(delta_types, stale_ranges, delta_folder_path):
+    stage4 = load_stage('Stage4-uploadToMongoDB.py')
+    for resource_type, ranges in stale_ranges.items():
+        collection = stage4.db[resource_type]
+        stale_ids = [f'{resource_type}/{counter}' for first, last in ranges for counter in range(first, last + 1)]
+        for start in range(0, len(stale_ids), 1000):
+            collection.delete_many({'_id': {'$in': stale_ids[start:start + 1000]}})
+        print(f'Removed {len(stale_ids)} stale documents from collection {resource_type}')
+    failed_documents = 0
+    for resource_type in sorted(delta_types):
+        delta_file_path = os.path.join(delta_folder_path, f'{resource_type}.ndjson')
+        _, failed = stage4.upload_collection(delta_file_path, resource_type, mode='upsert', checkpoint=False)
+        failed_documents += failed
+    stage4.create_indexes(sorted(delta_types))
+    if failed_documents:
+        # Raised before the manifest is saved, so a rerun processes the same bundles again with the same IDs
+        raise stage4.UploadFailedError(f'{failed_documents} documents of the delta failed to upload; run the refresh again')
+
+def run_incremental_pipeline(folder_path, enriched_folder_path, delta_folder_path, manifest_file_path,
+                             embeddings_total=25, upload=False, patient_index_file_path=patient_index_file_path):
+    manifest = load_manifest(manifest_file_path)
+    if manifest is None:
+        # Without a manifest nothing in the enriched folder can be attributed to a bundle, so start over
+        manifest = {'counters': {}, 'bundles': {}}
+        remove_enriched_files(enriched_folder_path)
+    stage1.clear_previous_output(delta_folder_path)
+
+    bundle_files = stage1.list_bundle_files(folder_path, max_patients=None)
+    bundle_hashes = {os.path.basename(file_path): hash_file(file_path) for file_path in bundle_files}
+    old_bundles = manifest['bundles']
+
+    changed_files = [file_path for file_path in bundle_files
+                     if old_bundles.get(os.path.basename(file_path), {}).get('sha256') != bundle_hashes[os.path.basename(file_path)]]
+    stale_bundles = [filename for filename, bundle_entry in old_bundles.items()
+                     if bundle_hashes.get(filename) != bundle_entry['sha256']]
+    removed_bundles = [filename for filename in old_bundles if filename not in bundle_hashes]
+    print(f'{len(bundle_files)} bundles: {len(changed_files)} new or changed, {len(removed_bundles)} removed, '
+          f'{len(bundle_files) - len(changed_files)} unchanged.')
+
+    stale_ranges = collect_ranges(old_bundles[filename] for filename in stale_bundles)
+    new_bundles = {filename: bundle_entry for filename, bundle_entry in old_bundles.items() if filename not in stale_bundles}
+    resource_counters = defaultdict(int, manifest['counters'])
+    embeddings_counter = defaultdict(int)
+    for bundle_entry in new_bundles.values():
+        for resource_type, count in bundle_entry.get('embeddings', {}).items():
+            embeddings_counter[resource_type] += count
+    embedded_ids = []
+    uuid_to_url_mapping = {}
+    changed_entries = {}
+    file_handles = {}
+
+    resources = split_changed_bundles(changed_files, bundle_hashes, resource_counters, uuid_to_url_mapping, changed_entries)
+    resources = fused.update_references(resources, uuid_to_url_mapping)
+    enriched_resources = fused.enrich_resources(resources, embeddings_total, embeddings_counter)
+    enriched_resources = fused.embed_resources(enriched_resources)
+
+    try:
+        for resource_type, enriched_resource in enriched_resources:
+            if resource_type not in file_handles:
+                delta_file_path = os.path.join(delta_folder_path, f'{resource_type}.ndjson')
+                file_handles[resource_type] = NDJSONWriter(delta_file_path)
+            file_handles[resource_type].write(enriched_resource)
+            if 'vectorSearchEmbeddings' in enriched_resource['metadata']:
+                embedded_ids.append(enriched_resource['resource']['id'])
+    finally:
+        for fh in file_handles.values():
+            fh.close()
+            metrics.count('bytes_written', fh.bytes_written)
+
+    count_bundle_embeddings(embedded_ids, changed_entries)
+    delta_types = set(file_handles)
+    dropped_ranges = collect_ranges(list(old_bundles[filename] for filename in stale_bundles) + list(changed_entries.values()))
+    for resource_type in sorted(delta_types | set(stale_ranges)):
+        merge_into_enriched_file(resource_type, dropped_ranges, enriched_folder_path, delta_folder_path)
+
+    if upload:
+        upload_delta(delta_types, stale_ranges, delta_folder_path)
+
+    new_bundles.update(changed_entries)
+    save_manifest(manifest_file_path, {'counters': dict(resource_counters), 'bundles': new_bundles})
+    write_patient_index_from_manifest(patient_index_file_path, new_bundles)
+    print(f'Incremental run completed. Delta saved in {delta_folder_path}, manifest saved in {manifest_file_path}, '
+          f'patient index saved in {patient_index_file_path}.')
+
+if __name__ == "__main__":
+    with run_stage('incremental-refresh'):
+        # upload=True also upserts the delta into MongoDB and deletes the documents of changed or removed bundles
+        run_incremental_pipeline(folder_path, enriched_folder_path, delta_folder_path, manifest_file_path,
+                                 embeddings_total=25, upload=True)
@@ -0,0 +1,98 @@
+import json
+import os
+from enriched_output import EnrichedResourceWriter, enriched_collection_name, iter_enriched
+from instrumentation import metrics, run_stage
+from reference_graph import open_patient_index, shard_for_patient
+
+# Optional step after Stage 3: splits the enriched resources into patient-partitioned shards, so every resource of
+# a patient lands in the same shard and downstream workers (or a sharded MongoDB load) can take whole patients
+# independently. The owner of each resource is the patient of the bundle it came from, read from the patient index
+# written by Stage 1; the shard is a stable hash of the patient ID. Synthea repeats the Organization, Practitioner
+# and Location resources in every bundle, and Stage 2 points all references to them at one copy, so these types
+# (shared_resource_types) go to the "shared" folder, like resources of bundles without a patient. A shard then
+# only references its own resources and the shared ones.
+#
+#   Dataset/patientShards/shard-000/<ResourceType>.ndjson
+#   ...
+#   Dataset/patientShards/shared/<ResourceType>.ndjson
+#   Dataset/patientShards/shards.json        resources and patients per shard
+
+base_dir = 'Dataset'
+
+enriched_folder_path = os.path.join(base_dir, 'enrichedResources')
+patient_index_file_path = os.path.join(base_dir, 'mergedPatientsPerResourceType', 'patient_index.bin')
+shards_folder_path = os.path.join(base_dir, 'patientShards')
+summary_file_path = os.path.join(shards_folder_path, 'shards.json')
+
+shard_count = 8
+# Same choices as Stage 3's enriched_output_format and enriched_vector_side_file
+shard_output_format = 'ndjson'
+shard_vector_side_file = False
+shared_folder_name = 'shared'
+shared_resource_types = {'Organization', 'Practitioner', 'PractitionerRole', 'Location'}
+
+def shard_folder_name(shard):
+    return f'shard-{shard:03d}'
+
+# Function to remove the shards of a previous run
+def clear_previous_shards(shards_folder_path):
+    if not os.path.isdir(shards_folder_path):
+        return
+    for folder_name in os.listdir(shards_folder_path):
+        folder_path = os.path.join(shards_folder_path, folder_name)
+        if os.path.isdir(folder_path) and (folder_name == shared_folder_name or folder_name.startswith('shard-')):
+            for filename in os.listdir(folder_path):
+                os.remove(os.path.join(folder_path, filename))
+
+# Function to copy the enriched resources of one type into the shard of their patient
+def partition_file(filename, patient_index, summary):
+    resource_type = enriched_collection_name(filename)
+    writers = {}
+    try:
+        for document, _ in iter_enriched(enriched_folder_path, filename):
+            resource = document.get('resource', document)
+            if resource_type in shared_resource_types:
+                folder_name = shared_folder_name
+            else:
+                # Stage 1 and the incremental refresh both write the index, so an ID it does not know means
+                # the index comes from another dataset
+                if not patient_index.contains(resource.get('id')):
+                    raise ValueError(f"{resource.get('id')} is not in {patient_index_file_path}: the patient index does "
+                                     f"not describe these enriched resources. Rebuild them with Stages 1 to 3 or the "
+                                     f"incremental refresh.")
+                patient_id = patient_index.patient_of(resource.get('id'))
+                folder_name = shard_folder_name(shard_for_patient(patient_id, shard_count)) if patient_id else shared_folder_name
+            if folder_name not in writers:
+                folder_path = os.path.join(shards_folder_path, folder_name)
+                os.makedirs(folder_path, exist_ok=True)
+                writers[folder_name] = EnrichedResourceWriter(folder_path, resource_type, shard_output_format, shard_vector_side_file)
+            writers[folder_name].write(document)
+            shard_summary = summary.setdefault(folder_name, {'resources': 0, 'patients': 0})
+            shard_summary['resources'] += 1
+            if resource_type == 'Patient':
+                shard_summary['patients'] += 1
+            metrics.count('resources')
+    finally:
+        for writer in writers.values():
+            writer.close()
+            metrics.count('bytes_written', writer.bytes_written)
+
+def partition_by_patient(enriched_folder_path, shards_folder_path):
+    clear_previous_shards(shards_folder_path)
+    filenames = sorted(filename for filename in os.listdir(enriched_folder_path) if enriched_collection_name(filename) is not None)
+    summary = {}
+    with open_patient_index(patient_index_file_path) as patient_index:
+        for filename in filenames:
+            with metrics.timer('partition'):
+                partition_file(filename, patient_index, summary)
+            metrics.log(f'Partitioned {filename}')
+            metrics.progress('files', len(filenames))
+
+    os.makedirs(shards_folder_path, exist_ok=True)
+    with open(summary_file_path, 'w', encoding='utf-8') as summary_file:
+        json.dump({'shard_count': shard_count, 'shards': dict(sorted(summary.items()))}, summary_file, indent=2)
+    print(f'Partitioned {len(filenames)} files into {len(summary)} folders in {shards_folder_path}.')
+
+if __name__ == "__main__":
+    with run_stage('partition-shard-by-patient'):
+        partition_by_patient(enriched_folder_path, shards_folder_path)
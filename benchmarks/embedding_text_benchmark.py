@@ -0,0 +1,100 @@
+import base64
+import binascii
+import glob
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import embedding_text
+from stage_modules import load_stage
+
+# Micro-benchmark for Stage 3 embedding text extraction on the bundled Synthea sample:
+# the original per-resource base64 decoding against the batched prepare_embedding_texts.
+# Base64 decoding dominates: the batched preparation only gets faster with pybase64 installed, and runs at
+# about the same speed as the per-item version with the standard library decoder.
+#   python benchmarks/embedding_text_benchmark.py [bundles_folder] [repeat] [copies]
+# copies repeats the sample's resources to get a larger chunk.
+
+stage3 = load_stage('Stage3-enrichMetadata.py')
+
+bundles_folder_path = os.path.join('Dataset', 'originalResources')
+
+
+# The extraction as it was before embedding_text.py, kept here as the baseline
+def prepare_embedding_text_per_item(resourceType, resource):
+    config = stage3.embeddings_config.get(resourceType)
+    if not config:
+        return None
+    data = resource
+    for part in config["path"].split('.'):
+        if '[]' in part:
+            part = part.replace('[]', '')
+            data = data.get(part, [])
+            if not isinstance(data, list):
+                return None
+            decoded_texts = []
+            for item in data:
+                if config.get("encodedBase64", False):
+                    if isinstance(item, dict) and 'data' in item:
+                        decoded_texts.append(base64.b64decode(item['data']).decode('utf-8'))
+                    else:
+                        return None
+                else:
+                    decoded_texts.append(item)
+            data = " ".join(decoded_texts)
+            break
+        else:
+            data = data.get(part, None)
+    if not data:
+        return None
+    return data.replace("\n", " ")
+
+
+def load_resources(bundles_folder_path):
+    resources = {}
+    for file_path in sorted(glob.glob(os.path.join(bundles_folder_path, '*.json'))):
+        with open(file_path, 'r', encoding='utf-8') as json_file:
+            data = json.load(json_file)
+        for entry in data.get('entry', []):
+            resource = entry.get('resource')
+            if resource and resource.get('resourceType') in stage3.embeddings_config:
+                resources.setdefault(resource['resourceType'], []).append(resource)
+    return resources
+
+
+def measure(prepare, resources, repeat):
+    best = float('inf')
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = 0
+        for resource_type, chunk in resources.items():
+            prepare(resource_type, chunk)
+            count += len(chunk)
+        best = min(best, time.perf_counter() - start)
+    return count / best
+
+
+def main(bundles_folder_path, repeat=5, copies=20):
+    resources = {resource_type: chunk * copies for resource_type, chunk in load_resources(bundles_folder_path).items()}
+    for resource_type, chunk in resources.items():
+        for resource, text in zip(chunk, stage3.prepare_embedding_texts(resource_type, chunk)):
+            expected = prepare_embedding_text_per_item(resource_type, resource)
+            if (expected.replace('\t', ' ').replace('\r', ' ').strip() or None if expected else None) != text:
+                raise AssertionError(f"Batched extraction differs for {resource_type}/{resource.get('id')}")
+
+    before = measure(lambda resource_type, chunk: [prepare_embedding_text_per_item(resource_type, resource) for resource in chunk], resources, repeat)
+    after = measure(stage3.prepare_embedding_texts, resources, repeat)
+    decoder = 'binascii' if embedding_text.decode_base64 is binascii.a2b_base64 else 'pybase64'
+    print(f'Resources: {sum(len(chunk) for chunk in resources.values())} (best of {repeat} runs, {decoder} decoder)')
+    print(f'Per-item decoding: {before:>12,.0f} resources/s')
+    print(f'Batched decoding:  {after:>12,.0f} resources/s ({after / before:.2f}x)')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else bundles_folder_path,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 20)
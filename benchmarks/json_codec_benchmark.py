@@ -0,0 +1,50 @@
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fhir_codec
+
+# Compares the JSON backends available to fhir_codec on the bundled Synthea sample: decoding whole bundles,
+# and encoding / decoding single resources the way the stages read and write NDJSON lines.
+#   python benchmarks/json_codec_benchmark.py [bundles_folder] [repeat]
+
+bundles_folder_path = os.path.join('Dataset', 'originalResources')
+
+
+def best_time(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(bundles_folder_path, repeat=5):
+    bundles = []
+    for file_path in sorted(glob.glob(os.path.join(bundles_folder_path, '*.json'))):
+        with open(file_path, 'rb') as file:
+            bundles.append(file.read())
+    bundle_bytes = sum(len(bundle) for bundle in bundles)
+
+    reference = fhir_codec.get_backend('json')
+    resources = [entry['resource'] for bundle in bundles for entry in reference.loads(bundle).get('entry', []) if entry.get('resource')]
+    lines = [reference.dumps(resource) for resource in resources]
+
+    print(f'{len(bundles)} bundles ({bundle_bytes / 1e6:.1f} MB), {len(resources)} resources, best of {repeat} runs')
+    print(f"{'backend':<10}{'bundle decode MB/s':>20}{'line encode res/s':>20}{'line decode res/s':>20}")
+    for name in fhir_codec.available_backends():
+        backend = fhir_codec.get_backend(name)
+        decode_bundles = best_time(lambda: [backend.loads(bundle) for bundle in bundles], repeat)
+        encode_lines = best_time(lambda: [backend.dumps(resource) for resource in resources], repeat)
+        decode_lines = best_time(lambda: [backend.loads(line) for line in lines], repeat)
+        print(f'{name:<10}{bundle_bytes / 1e6 / decode_bundles:>20,.1f}'
+              f'{len(resources) / encode_lines:>20,.0f}{len(resources) / decode_lines:>20,.0f}')
+    print(f'Selected backend: {fhir_codec.backend.name}')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else bundles_folder_path, int(sys.argv[2]) if len(sys.argv) > 2 else 5)
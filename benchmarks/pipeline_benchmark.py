@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_bundles import write_bundles
+
+# End-to-end benchmark: generates synthetic Synthea-shaped bundles, runs every stage on them with the fake
+# embedder and a mongomock database (or a real MongoDB with --mongodb-uri), and compares throughput and peak
+# memory with a stored baseline.
+#   python benchmarks/pipeline_benchmark.py [--patients 200] [--resources-per-patient 100] [--save-baseline]
+#
+# Every stage runs in its own process, so its peak RSS is not hidden by the stages before it. The numbers come
+# from the stage's run report (instrumentation.py). Exits with status 1 when a stage is slower or uses more
+# memory than the baseline by more than --tolerance.
+
+stage_names = ('stage1', 'stage2', 'stage3', 'stage4', 'fused')
+baseline_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline_baseline.json')
+
+
+# Runs one stage in the current process (the child side of run_stage_process) and prints its report path
+def run_stage_here(stage_name, workers, mongodb_uri, upload_engine=None):
+    from instrumentation import run_stage
+    from stage_modules import load_stage
+
+    with run_stage(f'benchmark-{stage_name}') as metrics:
+        if stage_name == 'stage1':
+            stage1 = load_stage('Stage1-splitBundlesAndMappingNewReferences.py')
+            stage1.process_files(stage1.folder_path, stage1.output_folder_path, None, workers=workers)
+        elif stage_name == 'stage2':
+            from uuid_mapping_store import open_mapping
+            stage2 = load_stage('Stage2-updateReferencesForAllResources.py')
+            with open_mapping(stage2.uuid_mapping_file_path) as uuid_to_url_mapping:
+                stage2.process_and_update_references(stage2.output_folder_path, uuid_to_url_mapping, workers=workers)
+        elif stage_name == 'stage3':
+            stage3 = load_stage('Stage3-enrichMetadata.py')
+            stage3.enrich_and_save_resources(stage3.input_folder_path, stage3.enriched_folder_path, stage3.uuid_mapping_file, embeddings_total=None, workers=workers)
+        elif stage_name == 'stage4':
+            stage4 = load_stage('Stage4-uploadToMongoDB.py')
+            if mongodb_uri:
+                import pymongo
+                client = pymongo.MongoClient(mongodb_uri)
+                client.drop_database('fhir_benchmark')
+                database = client['fhir_benchmark']
+            else:
+                import mongomock
+                database = mongomock.MongoClient()['fhir_benchmark']
+            stage4.main(database=database, resume=False, engine=upload_engine)
+            metrics.count('resources', metrics.counters.get('documents_uploaded', 0))
+        elif stage_name == 'fused':
+            fused = load_stage('StageFused-splitUpdateAndEnrich.py')
+            fused.run_fused_pipeline(fused.folder_path, fused.enriched_folder_path, None, embeddings_total=None)
+    print(f'BENCHMARK_REPORT {metrics.report_path}')
+
+
+def run_stage_process(stage_name, work_folder_path, workers, mongodb_uri, upload_engine=None):
+    # Every stage starts with an empty embeddings cache, so Stage 3 and the fused stage both embed every text
+    shutil.rmtree(os.path.join(work_folder_path, 'Dataset', 'embeddingsCache'), ignore_errors=True)
+    command = [sys.executable, os.path.abspath(__file__), '--run-stage', stage_name, '--work-folder', work_folder_path]
+    if workers is not None:
+        command += ['--workers', str(workers)]
+    if mongodb_uri:
+        command += ['--mongodb-uri', mongodb_uri]
+    if upload_engine:
+        command += ['--upload-engine', upload_engine]
+    env = dict(os.environ, EMBEDDINGS_BACKEND='fake', PIPELINE_QUIET='1', DATABASE=os.getenv('DATABASE') or 'fhir_benchmark',
+               PYTHONPATH=os.pathsep.join(filter(None, [repo_path, os.getenv('PYTHONPATH')])))
+    result = subprocess.run(command, cwd=work_folder_path, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stdout)
+        print(result.stderr)
+        raise RuntimeError(f'{stage_name} failed with exit status {result.returncode}')
+    report_path = [line.split(' ', 1)[1] for line in result.stdout.splitlines() if line.startswith('BENCHMARK_REPORT ')][-1]
+    with open(os.path.join(work_folder_path, report_path), 'r', encoding='utf-8') as report_file:
+        report = json.load(report_file)
+
+    peak_rss = report['peak_rss_bytes'] or {}
+    resources = report['counters'].get('resources', 0)
+    return {
+        'elapsed_seconds': report['elapsed_seconds'],
+        'resources': resources,
+        'resources_per_second': resources / report['elapsed_seconds'] if report['elapsed_seconds'] > 0 else 0.0,
+        'peak_rss_mb': max(peak_rss.values(), default=0) / 1024 ** 2,
+    }
+
+
+# Returns one line per regression: throughput below, or peak memory above, the baseline by more than tolerance
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+    for stage_name, result in results.items():
+        expected = baseline.get(stage_name)
+        if not expected:
+            continue
+        if result['resources_per_second'] < expected['resources_per_second'] * (1 - tolerance):
+            regressions.append(f"{stage_name}: {result['resources_per_second']:,.0f} resources/s, baseline {expected['resources_per_second']:,.0f}")
+        if result['peak_rss_mb'] > expected['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{stage_name}: peak RSS {result['peak_rss_mb']:.0f} MB, baseline {expected['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def print_results(results, baseline):
+    print(f"{'stage':<8}{'seconds':>10}{'resources':>12}{'resources/s':>14}{'vs baseline':>13}{'peak RSS MB':>13}{'vs baseline':>13}")
+    for stage_name, result in results.items():
+        expected = baseline.get(stage_name) or {}
+        speed = f"{result['resources_per_second'] / expected['resources_per_second'] - 1:+.0%}" if expected.get('resources_per_second') else '-'
+        memory = f"{result['peak_rss_mb'] / expected['peak_rss_mb'] - 1:+.0%}" if expected.get('peak_rss_mb') else '-'
+        print(f"{stage_name:<8}{result['elapsed_seconds']:>10.2f}{result['resources']:>12}{result['resources_per_second']:>14,.0f}"
+              f"{speed:>13}{result['peak_rss_mb']:>13.1f}{memory:>13}")
+
+
+def main(arguments):
+    scale = f'{arguments.patients}x{arguments.resources_per_patient}'
+    work_folder_path = arguments.work_folder or tempfile.mkdtemp(prefix='fhir-benchmark-')
+    bundles_folder_path = os.path.join(work_folder_path, 'Dataset', 'originalFHIRBundles')
+    shutil.rmtree(os.path.join(work_folder_path, 'Dataset'), ignore_errors=True)
+    write_bundles(bundles_folder_path, arguments.patients, arguments.resources_per_patient, arguments.seed)
+    print(f'Generated {arguments.patients} bundles of about {arguments.resources_per_patient} resources in {bundles_folder_path}')
+
+    results = {}
+    try:
+        for stage_name in arguments.stages.split(','):
+            results[stage_name] = run_stage_process(stage_name, work_folder_path, arguments.workers, arguments.mongodb_uri, arguments.upload_engine)
+    finally:
+        if not arguments.keep and not arguments.work_folder:
+            shutil.rmtree(work_folder_path, ignore_errors=True)
+
+    baselines = {}
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline, 'r', encoding='utf-8') as baseline_file:
+            baselines = json.load(baseline_file)
+    baseline = baselines.get(scale, {})
+    print(f'Scale {scale}' + ('' if baseline else ' (no baseline yet)'))
+    print_results(results, baseline)
+
+    if arguments.save_baseline:
+        baselines[scale] = results
+        with open(arguments.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2)
+        print(f'Baseline saved in {arguments.baseline}')
+        return 0
+
+    regressions = compare_with_baseline(results, baseline, arguments.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End-to-end pipeline benchmark on synthetic bundles')
+    parser.add_argument('--patients', type=int, default=200)
+    parser.add_argument('--resources-per-patient', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stages', default=','.join(stage_names),
+                        help='comma-separated, run in this order; each stage reads the output of the ones before it as in a normal run')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes for Stages 1 to 3 (default: one per CPU)')
+    parser.add_argument('--mongodb-uri', default=None, help='benchmark Stage 4 against this MongoDB instead of mongomock')
+    parser.add_argument('--upload-engine', choices=('threads', 'async'), default=None, help='Stage 4 upload engine (default: upload_engine)')
+    parser.add_argument('--baseline', default=baseline_file_path)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline for this scale')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown or memory growth (0.2 = 20%%)')
+    parser.add_argument('--work-folder', default=None, help='folder to run in (default: a temporary folder)')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary folder')
+    parser.add_argument('--run-stage', choices=stage_names, help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.run_stage:
+        run_stage_here(arguments.run_stage, arguments.workers, arguments.mongodb_uri, arguments.upload_engine)
+    else:
+        sys.exit(main(arguments))
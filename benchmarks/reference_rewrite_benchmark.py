@@ -0,0 +1,112 @@
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fhir_codec
+from fhir_codec import NDJSONWriter
+from reference_graph import EdgeCollector
+from stage_modules import load_stage
+
+# Micro-benchmark for the Stage 2 reference rewrite on the bundled Synthea sample: the original recursive
+# walk of every parsed resource against update_references_in_file with its copy and byte-substitution paths,
+# in the default configuration and with build_reference_graph=True.
+#   python benchmarks/reference_rewrite_benchmark.py [bundles_folder] [repeat] [copies]
+# copies repeats the sample's bundles to get larger files (the repeated UUIDs map to the last copy).
+
+stage1 = load_stage('Stage1-splitBundlesAndMappingNewReferences.py')
+stage2 = load_stage('Stage2-updateReferencesForAllResources.py')
+
+bundles_folder_path = os.path.join('Dataset', 'originalResources')
+
+
+# The rewrite as it was before, kept here as the baseline
+def update_references_recursive(resource, uuid_to_url_mapping):
+    for key, value in resource.items():
+        if isinstance(value, dict):
+            update_references_recursive(value, uuid_to_url_mapping)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    update_references_recursive(item, uuid_to_url_mapping)
+        elif key == 'reference' and value.startswith('urn:uuid:'):
+            if value in uuid_to_url_mapping:
+                resource[key] = uuid_to_url_mapping[value]
+
+
+def update_references_in_file_recursive(file_path, uuid_to_url_mapping):
+    with NDJSONWriter(file_path + '.tmp') as temp_file:
+        for resource in fhir_codec.iter_ndjson(file_path):
+            update_references_recursive(resource, uuid_to_url_mapping)
+            temp_file.write(resource)
+    os.replace(file_path + '.tmp', file_path)
+
+
+# Writes the sample as Stage 1 would and returns the UUID mapping
+def write_stage1_files(bundles_folder_path, folder_path, copies):
+    resource_counters = defaultdict(int)
+    uuid_to_url_mapping = {}
+    writers = {}
+    for _ in range(copies):
+        for file_path in sorted(glob.glob(os.path.join(bundles_folder_path, '*.json'))):
+            data = fhir_codec.load_file(file_path)
+            for resource_type, resource, _ in stage1.split_bundle(data, resource_counters, uuid_to_url_mapping):
+                if resource_type not in writers:
+                    writers[resource_type] = NDJSONWriter(os.path.join(folder_path, f'{resource_type}.ndjson'))
+                writers[resource_type].write(resource)
+    for writer in writers.values():
+        writer.close()
+    return uuid_to_url_mapping
+
+
+def measure(rewrite, source_folder_path, work_folder_path, uuid_to_url_mapping, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        shutil.rmtree(work_folder_path, ignore_errors=True)
+        shutil.copytree(source_folder_path, work_folder_path)
+        file_paths = sorted(glob.glob(os.path.join(work_folder_path, '*.ndjson')))
+        start = time.perf_counter()
+        for file_path in file_paths:
+            rewrite(file_path, uuid_to_url_mapping)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def read_folder(folder_path):
+    return {os.path.basename(file_path): open(file_path, 'rb').read() for file_path in sorted(glob.glob(os.path.join(folder_path, '*.ndjson')))}
+
+
+def main(bundles_folder_path, repeat=5, copies=5):
+    temp_folder_path = tempfile.mkdtemp(prefix='reference-rewrite-')
+    try:
+        source_folder_path = os.path.join(temp_folder_path, 'source')
+        before_folder_path = os.path.join(temp_folder_path, 'before')
+        after_folder_path = os.path.join(temp_folder_path, 'after')
+        os.makedirs(source_folder_path)
+        uuid_to_url_mapping = write_stage1_files(bundles_folder_path, source_folder_path, copies)
+        lines = sum(content.count(b'\n') for content in read_folder(source_folder_path).values())
+
+        before = measure(update_references_in_file_recursive, source_folder_path, before_folder_path, uuid_to_url_mapping, repeat)
+        after = measure(stage2.update_references_in_file, source_folder_path, after_folder_path, uuid_to_url_mapping, repeat)
+        if read_folder(before_folder_path) != read_folder(after_folder_path):
+            raise AssertionError('The rewritten files differ from the recursive rewrite')
+        with_graph = measure(lambda file_path, mapping: stage2.update_references_in_file(file_path, mapping, EdgeCollector()),
+                             source_folder_path, after_folder_path, uuid_to_url_mapping, repeat)
+
+        print(f'Resources: {lines} (best of {repeat} runs)')
+        print(f'Recursive walk:           {lines / before:>12,.0f} resources/s')
+        print(f'Stage 2 default settings: {lines / after:>12,.0f} resources/s ({before / after:.2f}x)')
+        print(f'With the reference graph: {lines / with_graph:>12,.0f} resources/s ({before / with_graph:.2f}x)')
+    finally:
+        shutil.rmtree(temp_folder_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else bundles_folder_path,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 5)
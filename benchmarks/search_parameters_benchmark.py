@@ -0,0 +1,90 @@
+import glob
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stage_modules import load_stage
+
+# Micro-benchmark for Stage 3 search-parameter extraction on the bundled Synthea sample:
+# the original per-resource path parsing against the precompiled extractors.
+#   python benchmarks/search_parameters_benchmark.py [bundles_folder] [repeat]
+
+stage3 = load_stage('Stage3-enrichMetadata.py')
+
+bundles_folder_path = os.path.join('Dataset', 'originalResources')
+
+
+# The extractor as it was before compile_search_parameters, kept here as the baseline
+def extract_search_parameter_values_uncompiled(resource):
+    resource_type = resource.get("resourceType")
+    params_config = stage3.search_parameters_config.get(resource_type, [])
+
+    extracted_values = []
+    for param in params_config:
+        attribute_path = param["attribute"].split('.')
+        value = resource
+        for part in attribute_path:
+            if '[' in part and ']' in part:
+                part, index = part.rstrip(']').split('[')
+                index = int(index)
+                if isinstance(value, dict) and part in value:
+                    value = value.get(part)
+                    if isinstance(value, list) and len(value) > index:
+                        value = value[index]
+                    else:
+                        value = None
+                else:
+                    value = None
+            else:
+                if isinstance(value, dict):
+                    value = value.get(part)
+                else:
+                    value = None
+
+            if value is None:
+                break
+
+        if value is not None:
+            extracted_values.append({"key": param["key"], "value": value})
+
+    return extracted_values
+
+
+def load_resources(bundles_folder_path):
+    resources = []
+    for file_path in sorted(glob.glob(os.path.join(bundles_folder_path, '*.json'))):
+        with open(file_path, 'r', encoding='utf-8') as json_file:
+            data = json.load(json_file)
+        resources.extend(entry['resource'] for entry in data.get('entry', []) if entry.get('resource'))
+    return resources
+
+
+def measure(extract, resources, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for resource in resources:
+            extract(resource)
+        best = min(best, time.perf_counter() - start)
+    return len(resources) / best
+
+
+def main(bundles_folder_path, repeat=5):
+    resources = load_resources(bundles_folder_path)
+    for resource in resources:
+        if extract_search_parameter_values_uncompiled(resource) != stage3.extract_search_parameter_values(resource):
+            raise AssertionError(f"Compiled extractor differs for {resource.get('resourceType')}/{resource.get('id')}")
+
+    before = measure(extract_search_parameter_values_uncompiled, resources, repeat)
+    after = measure(stage3.extract_search_parameter_values, resources, repeat)
+    print(f'Resources: {len(resources)} (best of {repeat} runs)')
+    print(f'Uncompiled paths:  {before:>12,.0f} resources/s')
+    print(f'Compiled paths:    {after:>12,.0f} resources/s')
+    print(f'Speed-up:          {after / before:>12.2f}x')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else bundles_folder_path, int(sys.argv[2]) if len(sys.argv) > 2 else 5)
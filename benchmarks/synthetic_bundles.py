@@ -0,0 +1,251 @@
+import base64
+import json
+import os
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+# Generates Synthea-shaped transaction bundles for benchmarks: one bundle per patient, resources cross-referenced
+# with "urn:uuid:" references, DiagnosticReport and DocumentReference notes as base64 attachments, and the same
+# organizations and practitioners repeated across bundles, as in Synthea exports. The resource mix follows the
+# bundled sample (mostly Observations, Procedures, DiagnosticReports, Encounters and DocumentReferences).
+#   python benchmarks/synthetic_bundles.py <output_folder> [patients] [resources_per_patient] [seed]
+
+# Relative frequency of the per-encounter resource types in the bundled sample
+resource_weights = {
+    'Observation': 562,
+    'Procedure': 339,
+    'DiagnosticReport': 334,
+    'DocumentReference': 300,
+    'Immunization': 37,
+    'Condition': 33,
+    'MedicationRequest': 22,
+    'CarePlan': 12,
+    'CareTeam': 12,
+    'MedicationStatement': 5,
+    'ImagingStudy': 1,
+}
+# Share of the per-patient resources that are encounters
+encounter_share = 0.15
+
+given_names = ['Abby', 'Ada', 'Adela', 'Bruno', 'Carmen', 'Dario', 'Elena', 'Felix', 'Grace', 'Hugo', 'Ines', 'Jonas']
+family_names = ['Schiller', 'Eichmann', 'Sanchez', 'Stehr', 'Okafor', 'Lindgren', 'Moreau', 'Tanaka', 'Weber', 'Costa']
+cities = ['Boston', 'Springfield', 'Worcester', 'Lowell', 'Cambridge', 'Quincy']
+note_words = (
+    'patient presents with mild moderate severe acute chronic pain fever cough fatigue history of hypertension '
+    'diabetes asthma reports denies follow-up in two weeks prescribed medication allergies none known vitals '
+    'stable blood pressure heart rate within normal limits assessment plan continue current therapy counseling '
+    'provided smoking cessation exercise diet screening negative positive referred to specialist'
+).split()
+# (system, code, display) samples per resource type
+codes = {
+    'Encounter': [('http://snomed.info/sct', '185349003', 'Encounter for check up'),
+                  ('http://snomed.info/sct', '162673000', 'General examination of patient')],
+    'Observation': [('http://loinc.org', '8302-2', 'Body Height'), ('http://loinc.org', '29463-7', 'Body Weight'),
+                    ('http://loinc.org', '8867-4', 'Heart rate'), ('http://loinc.org', '2339-0', 'Glucose')],
+    'Procedure': [('http://snomed.info/sct', '430193006', 'Medication Reconciliation'),
+                  ('http://snomed.info/sct', '710824005', 'Assessment of health and social care needs')],
+    'DiagnosticReport': [('http://loinc.org', '34117-2', 'History and physical note'),
+                         ('http://loinc.org', '51990-0', 'Basic metabolic panel')],
+    'Condition': [('http://snomed.info/sct', '44054006', 'Diabetes'), ('http://snomed.info/sct', '38341003', 'Hypertension')],
+    'Immunization': [('http://hl7.org/fhir/sid/cvx', '140', 'Influenza, seasonal'), ('http://hl7.org/fhir/sid/cvx', '113', 'Td')],
+    'Medication': [('http://www.nlm.nih.gov/research/umls/rxnorm', '314076', 'lisinopril 10 MG Oral Tablet'),
+                   ('http://www.nlm.nih.gov/research/umls/rxnorm', '860975', 'metformin 500 MG Oral Tablet')],
+}
+
+
+def make_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def codeable_concept(rng, resource_type):
+    system, code, display = rng.choice(codes[resource_type])
+    return {'coding': [{'system': system, 'code': code, 'display': display}], 'text': display}
+
+
+def fhir_datetime(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+
+def make_note(rng):
+    lines = []
+    for _ in range(rng.randint(6, 14)):
+        lines.append(' '.join(rng.choice(note_words) for _ in range(rng.randint(6, 14))).capitalize() + '.')
+    return base64.b64encode('\n'.join(lines).encode('utf-8')).decode('ascii')
+
+
+# Organizations, practitioners and locations shared by every bundle, like Synthea's providers
+def make_providers(rng, count):
+    providers = []
+    for index in range(count):
+        organization_id, practitioner_id, role_id, location_id = (make_uuid(rng) for _ in range(4))
+        city = rng.choice(cities)
+        providers.append([
+            {'resourceType': 'Organization', 'id': organization_id, 'active': True, 'name': f'{city} Health Center {index}',
+             'type': [{'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/organization-type', 'code': 'prov', 'display': 'Healthcare Provider'}]}],
+             'address': [{'line': [f'{index} Main Street'], 'city': city, 'state': 'MA', 'text': f'{index} Main Street, {city}, MA'}]},
+            {'resourceType': 'Practitioner', 'id': practitioner_id, 'active': True, 'gender': rng.choice(['male', 'female']),
+             'identifier': [{'system': 'http://hl7.org/fhir/sid/us-npi', 'value': str(9999900000 + index)}],
+             'name': [{'family': rng.choice(family_names), 'given': [rng.choice(given_names)], 'prefix': ['Dr.']}],
+             'address': [{'line': [f'{index} Main Street'], 'city': city, 'state': 'MA'}]},
+            {'resourceType': 'PractitionerRole', 'id': role_id, 'practitioner': {'reference': f'urn:uuid:{practitioner_id}'},
+             'organization': {'reference': f'urn:uuid:{organization_id}'},
+             'code': [{'coding': [{'system': 'http://nucc.org/provider-taxonomy', 'code': '208D00000X', 'display': 'General Practice'}]}]},
+            {'resourceType': 'Location', 'id': location_id, 'status': 'active', 'name': f'{city} Health Center {index}',
+             'address': {'line': [f'{index} Main Street'], 'city': city, 'state': 'MA', 'text': f'{index} Main Street, {city}, MA'},
+             'type': [{'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/v3-RoleCode', 'code': 'HOSP', 'display': 'Hospital'}]}],
+             'managingOrganization': {'reference': f'urn:uuid:{organization_id}'}},
+        ])
+    return providers
+
+
+def make_patient(rng, patient_id):
+    given = rng.choice(given_names)
+    family = rng.choice(family_names)
+    city = rng.choice(cities)
+    birth_date = datetime(1940, 1, 1) + timedelta(days=rng.randint(0, 365 * 80))
+    return {
+        'resourceType': 'Patient', 'id': patient_id,
+        'identifier': [{'system': 'https://github.com/synthetichealth/synthea', 'value': patient_id}],
+        'name': [{'use': 'official', 'family': family, 'given': [given]}],
+        'telecom': [{'system': 'phone', 'value': f'555-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}'},
+                    {'system': 'email', 'value': f'{given.lower()}.{family.lower()}@example.com'}],
+        'gender': rng.choice(['male', 'female']),
+        'birthDate': birth_date.strftime('%Y-%m-%d'),
+        'deceasedBoolean': False,
+        'address': [{'line': [f'{rng.randint(1, 999)} Elm Street'], 'city': city, 'state': 'MA', 'postalCode': f'0{rng.randint(1000, 2799)}'}],
+        'communication': [{'language': {'coding': [{'system': 'urn:ietf:bcp:47', 'code': 'en-US', 'display': 'English'}]}}],
+    }
+
+
+# Builds one resource of resource_type for an encounter; context holds the references it can point to
+def make_resource(rng, resource_type, resource_id, context):
+    patient = {'reference': f"urn:uuid:{context['patient']}"}
+    encounter = {'reference': f"urn:uuid:{context['encounter']}"}
+    moment = fhir_datetime(context['moment'])
+    resource = {'resourceType': resource_type, 'id': resource_id}
+    if resource_type == 'Observation':
+        resource.update(status='final', subject=patient, encounter=encounter, effectiveDateTime=moment, issued=moment,
+                        category=[{'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/observation-category', 'code': 'vital-signs'}]}],
+                        code=codeable_concept(rng, 'Observation'),
+                        valueQuantity={'value': round(rng.uniform(40, 200), 1), 'unit': 'kg', 'system': 'http://unitsofmeasure.org', 'code': 'kg'})
+    elif resource_type == 'Procedure':
+        resource.update(status='completed', subject=patient, encounter=encounter, performedDateTime=moment,
+                        code=codeable_concept(rng, 'Procedure'), location={'reference': f"urn:uuid:{context['location']}"})
+    elif resource_type == 'DiagnosticReport':
+        results = [{'reference': f'urn:uuid:{observation}'} for observation in context['observations'][-3:]]
+        resource.update(status='final', subject=patient, encounter=encounter, effectiveDateTime=moment, issued=moment,
+                        category=[{'coding': [{'system': 'http://loinc.org', 'code': '34117-2', 'display': 'History and physical note'}]}],
+                        code=codeable_concept(rng, 'DiagnosticReport'),
+                        performer=[{'reference': f"urn:uuid:{context['practitioner']}"}], result=results,
+                        presentedForm=[{'contentType': 'text/plain; charset=utf-8', 'data': make_note(rng)}])
+    elif resource_type == 'DocumentReference':
+        resource.update(status='superseded', subject=patient, date=moment,
+                        type={'coding': [{'system': 'http://loinc.org', 'code': '34117-2', 'display': 'History and physical note'}]},
+                        category=[{'coding': [{'system': 'http://hl7.org/fhir/us/core/CodeSystem/us-core-documentreference-category', 'code': 'clinical-note'}]}],
+                        author=[{'reference': f"urn:uuid:{context['practitioner']}"}],
+                        custodian={'reference': f"urn:uuid:{context['organization']}"},
+                        content=[{'attachment': {'contentType': 'text/plain; charset=utf-8', 'data': make_note(rng)}}],
+                        context={'encounter': [encounter]})
+    elif resource_type == 'Immunization':
+        resource.update(status='completed', patient=patient, encounter=encounter, occurrenceDateTime=moment,
+                        vaccineCode=codeable_concept(rng, 'Immunization'), primarySource=True)
+    elif resource_type == 'Condition':
+        resource.update(subject=patient, encounter=encounter, onsetDateTime=moment, recordedDate=moment,
+                        clinicalStatus={'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/condition-clinical', 'code': 'active'}]},
+                        code=codeable_concept(rng, 'Condition'))
+    elif resource_type in ('MedicationRequest', 'MedicationStatement'):
+        resource.update(status='active', subject=patient, medicationCodeableConcept=codeable_concept(rng, 'Medication'))
+        if resource_type == 'MedicationRequest':
+            resource.update(intent='order', encounter=encounter, authoredOn=moment, requester={'reference': f"urn:uuid:{context['practitioner']}"})
+        else:
+            resource.update(effectiveDateTime=moment, context=encounter)
+    elif resource_type == 'CarePlan':
+        resource.update(status='active', intent='order', subject=patient, encounter=encounter, period={'start': moment},
+                        category=[{'coding': [{'system': 'http://snomed.info/sct', 'code': '734163000', 'display': 'Care plan'}]}],
+                        careTeam=[{'reference': f"urn:uuid:{context['care_team']}"}] if context.get('care_team') else [])
+    elif resource_type == 'CareTeam':
+        context['care_team'] = resource_id
+        resource.update(status='active', subject=patient, encounter=encounter, period={'start': moment},
+                        participant=[{'member': {'reference': f"urn:uuid:{context['practitioner']}"}}],
+                        managingOrganization=[{'reference': f"urn:uuid:{context['organization']}"}])
+    elif resource_type == 'ImagingStudy':
+        resource.update(status='available', subject=patient, encounter=encounter, started=moment,
+                        series=[{'uid': resource_id, 'modality': {'system': 'http://dicom.nema.org/resources/ontology/DCM', 'code': 'DX'}}])
+    return resource
+
+
+def make_encounter(rng, encounter_id, context):
+    moment = fhir_datetime(context['moment'])
+    return {
+        'resourceType': 'Encounter', 'id': encounter_id, 'status': 'finished',
+        'class': {'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'AMB'},
+        'type': [codeable_concept(rng, 'Encounter')],
+        'subject': {'reference': f"urn:uuid:{context['patient']}"},
+        'participant': [{'individual': {'reference': f"urn:uuid:{context['practitioner']}"}}],
+        'period': {'start': moment, 'end': moment},
+        'location': [{'location': {'reference': f"urn:uuid:{context['location']}"}}],
+        'serviceProvider': {'reference': f"urn:uuid:{context['organization']}"},
+    }
+
+
+# Returns (file_name, bundle) for one patient with about resources_per_patient resources
+def generate_bundle(rng, resources_per_patient, providers):
+    patient_id = make_uuid(rng)
+    organization, practitioner, role, location = rng.choice(providers)
+    resources = [make_patient(rng, patient_id), organization, practitioner, role, location]
+    context = {
+        'patient': patient_id, 'organization': organization['id'], 'practitioner': practitioner['id'],
+        'location': location['id'], 'observations': [],
+        'moment': datetime(2010, 1, 1) + timedelta(days=rng.randint(0, 365 * 10)),
+    }
+
+    remaining = max(1, resources_per_patient - len(resources))
+    encounters = max(1, round(remaining * encounter_share))
+    per_encounter_types = rng.choices(list(resource_weights), weights=list(resource_weights.values()), k=remaining - encounters)
+    for encounter_index in range(encounters):
+        context['encounter'] = make_uuid(rng)
+        context['moment'] += timedelta(days=rng.randint(7, 120))
+        resources.append(make_encounter(rng, context['encounter'], context))
+        for resource_type in per_encounter_types[encounter_index::encounters]:
+            resource_id = make_uuid(rng)
+            resources.append(make_resource(rng, resource_type, resource_id, context))
+            if resource_type == 'Observation':
+                context['observations'].append(resource_id)
+
+    bundle = {
+        'resourceType': 'Bundle',
+        'type': 'transaction',
+        'entry': [
+            {'fullUrl': f"urn:uuid:{resource['id']}", 'resource': resource,
+             'request': {'method': 'POST', 'url': resource['resourceType']}}
+            for resource in resources
+        ],
+    }
+    name = resources[0]['name'][0]
+    return f"{name['given'][0]}{rng.randint(100, 999)}_{name['family']}{rng.randint(100, 999)}_{patient_id}.json", bundle
+
+
+# Writes `patients` bundles to folder_path; the same seed always gives the same bundles
+def write_bundles(folder_path, patients, resources_per_patient=100, seed=1, provider_count=20):
+    rng = random.Random(seed)
+    providers = make_providers(rng, provider_count)
+    os.makedirs(folder_path, exist_ok=True)
+    file_paths = []
+    for _ in range(patients):
+        file_name, bundle = generate_bundle(rng, resources_per_patient, providers)
+        file_path = os.path.join(folder_path, file_name)
+        with open(file_path, 'w', encoding='utf-8') as bundle_file:
+            json.dump(bundle, bundle_file)
+        file_paths.append(file_path)
+    return file_paths
+
+
+if __name__ == "__main__":
+    output_folder_path = sys.argv[1]
+    patients = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    resources_per_patient = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    file_paths = write_bundles(output_folder_path, patients, resources_per_patient, seed)
+    print(f'{len(file_paths)} bundles of about {resources_per_patient} resources written to {output_folder_path}')
@@ -0,0 +1,124 @@
+import binascii
+
+# Batched extraction of embedding input texts, used by Stage 3.
+#
+# An embeddings_config path such as "presentedForm[].data" is compiled once into lookup steps, where "[]"
+# fans out over every element of a list. The texts of a whole chunk of resources are prepared in one call:
+# each value is base64-decoded (when "encodedBase64" is set), its whitespace normalized and its UTF-8 decoded
+# with one C-level call each, and the texts are truncated to the model's input token limit.
+
+# Marks a "[]" step: continue with every element of the list
+EACH = None
+
+# Input limits of the OpenAI embedding models; set "maxTokens" in embeddings_config for other models
+embedding_model_max_tokens = {
+    'text-embedding-3-small': 8191,
+    'text-embedding-3-large': 8191,
+    'text-embedding-ada-002': 8191,
+}
+default_max_tokens = 8191
+
+# Without tiktoken, texts are cut at this many characters per token. English clinical notes average
+# about 4 characters per token, so 3 stays under the limit for text dense in numbers and codes.
+chars_per_token = 3
+
+# Newlines, tabs and other ASCII whitespace become plain spaces, in one C-level pass over the decoded bytes
+whitespace_to_space = bytes.maketrans(b'\t\n\x0b\x0c\r', b'     ')
+
+# pybase64 (SIMD base64) decodes several times faster than binascii when it is installed
+try:
+    from pybase64 import b64decode as decode_base64
+except ImportError:
+    decode_base64 = binascii.a2b_base64
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encodings = {}
+
+
+def compile_embedding_path(path):
+    steps = []
+    for part in path.split('.'):
+        if part.endswith('[]'):
+            steps.append(part[:-2])
+            steps.append(EACH)
+        else:
+            steps.append(part)
+    return tuple(steps)
+
+
+# Returns the values at the end of the compiled path, or None when the resource does not have the expected structure
+def extract_values(resource, steps):
+    values = [resource]
+    for step in steps:
+        next_values = []
+        if step is EACH:
+            for value in values:
+                if type(value) is not list:
+                    return None
+                next_values.extend(value)
+        else:
+            for value in values:
+                if type(value) is not dict:
+                    return None
+                value = value.get(step)
+                if value is not None:
+                    next_values.append(value)
+        values = next_values
+    return values
+
+
+def max_tokens_for(config):
+    return config.get('maxTokens') or embedding_model_max_tokens.get(config.get('model'), default_max_tokens)
+
+
+def truncate_texts(texts, model, max_tokens):
+    max_chars = max_tokens * chars_per_token
+    if tiktoken is None:
+        return [text[:max_chars] if text is not None and len(text) > max_chars else text for text in texts]
+
+    # Every token is at least one character, so only texts longer than max_tokens need to be counted
+    long_indexes = [index for index, text in enumerate(texts) if text is not None and len(text) > max_tokens]
+    if not long_indexes:
+        return texts
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding('cl100k_base')
+    encoding = _encodings[model]
+    texts = list(texts)
+    for index, tokens in zip(long_indexes, encoding.encode_ordinary_batch([texts[index] for index in long_indexes])):
+        if len(tokens) > max_tokens:
+            texts[index] = encoding.decode(tokens[:max_tokens])
+    return texts
+
+
+# Returns one embedding-ready text per resource (None when a resource has nothing to embed)
+def prepare_texts(resources, config, steps=None):
+    steps = steps or compile_embedding_path(config['path'])
+    encoded_base64 = config.get('encodedBase64', False)
+
+    texts = []
+    for resource in resources:
+        values = extract_values(resource, steps)
+        if not values:
+            texts.append(None)
+            continue
+        try:
+            if encoded_base64:
+                # Most resources hold a single attachment
+                text_bytes = decode_base64(values[0]) if len(values) == 1 else b' '.join([decode_base64(value) for value in values])
+            else:
+                text_bytes = ' '.join([value if type(value) is str else str(value) for value in values]).encode('utf-8')
+        # binascii.Error is a ValueError; a plain ValueError means a str value with non-ASCII characters
+        except (TypeError, ValueError) as e:
+            print(f"Error decoding base64 in {resource.get('resourceType')}/{resource.get('id')}: {e}")
+            texts.append(None)
+            continue
+        texts.append(text_bytes.translate(whitespace_to_space).decode('utf-8', errors='replace').strip() or None)
+
+    return truncate_texts(texts, config.get('model'), max_tokens_for(config))
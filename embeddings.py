@@ -0,0 +1,330 @@
+import hashlib
+import os
+import random
+import sqlite3
+import struct
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import metrics
+
+# Embedding backends and the batched, concurrent, rate-limit-aware scheduler used by Stage 3.
+#
+# A backend is any object with an embed(texts, model) method returning one vector per text, in order, and a
+# cache_namespace naming where its vectors come from, so the cache never serves one backend's vectors to another.
+
+# Vectors are stored as float64 so a cached vector is exactly the one the API returned
+VECTOR_TYPECODE = 'd'
+
+
+class OpenAIEmbedder:
+    # Calls the OpenAI embeddings API. The client is created on first use, so importing this
+    # module (or running with another backend) does not require the openai package or a key.
+    cache_namespace = 'openai'
+
+    def __init__(self, api_key=None, client=None):
+        self.api_key = api_key
+        self.client = client
+        self.lock = threading.Lock()
+
+    def embed(self, texts, model):
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    from openai import OpenAI
+                    self.client = OpenAI(api_key=self.api_key)
+        response = self.client.embeddings.create(input=texts, model=model)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class FakeEmbedder:
+    # Offline backend: deterministic unit vectors derived from a hash of the model and text.
+    # latency (seconds per request) simulates the network round trip for throughput tests.
+    def __init__(self, dimensions=1536, latency=0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.cache_namespace = f'fake-{dimensions}'
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def embed(self, texts, model):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.embed_text(text, model) for text in texts]
+
+    def embed_text(self, text, model):
+        seed = hashlib.blake2b(f'{model}\0{text}'.encode('utf-8'), digest_size=8).digest()
+        generator = random.Random(struct.unpack('<Q', seed)[0])
+        vector = [generator.gauss(0.0, 1.0) for _ in range(self.dimensions)]
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        return [value / norm for value in vector]
+
+
+class EmbeddingCache:
+    # Persistent content-addressed cache: SQLite rows keyed by a hash of the backend's namespace, the
+    # model name and the whitespace-normalized text, so vectors of the fake backend never stand in for
+    # OpenAI ones. When the stored vectors exceed max_bytes the least recently used ones are evicted
+    # down to 90% of it. The total size is kept in the cache_size table and updated in the same write
+    # transaction as the vectors, so it holds when several worker processes share the file.
+    def __init__(self, file_path, max_bytes=2 * 1024 ** 3, namespace=''):
+        self.file_path = file_path
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)')
+        self.connection.execute('INSERT OR IGNORE INTO cache_size VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM embeddings))')
+        self.connection.commit()
+        self.total_bytes = self.read_total_bytes()
+
+    def read_total_bytes(self):
+        return self.connection.execute('SELECT bytes FROM cache_size WHERE id = 0').fetchone()[0]
+
+    def make_key(self, text, model):
+        normalized_text = ' '.join(text.split())
+        return hashlib.sha256(f'{self.namespace}\0{model}\0{normalized_text}'.encode('utf-8')).hexdigest()
+
+    # Returns one vector (or None on a miss) per text
+    def get_many(self, texts, model):
+        keys = [self.make_key(text, model) for text in texts]
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = list(set(keys[start:start + 500]))
+                placeholders = ','.join('?' * len(chunk))
+                for key, blob in self.connection.execute(
+                        f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', chunk):
+                    found[key] = array(VECTOR_TYPECODE, blob).tolist()
+            if found:
+                now = time.time()
+                self.connection.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+                self.connection.commit()
+            vectors = [found.get(key) for key in keys]
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return vectors
+
+    def put_many(self, texts, vectors, model):
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            if vector is not None:
+                blob = array(VECTOR_TYPECODE, vector).tobytes()
+                rows.append((self.make_key(text, model), blob, len(blob), now))
+        if not rows:
+            return
+        with self.lock:
+            # Takes the write lock before reading sizes, so no other process changes them until the commit
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                added_bytes = 0
+                for key, _, size, _ in rows:
+                    previous = self.connection.execute('SELECT size FROM embeddings WHERE key = ?', (key,)).fetchone()
+                    added_bytes += size - (previous[0] if previous else 0)
+                self.connection.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+                self.connection.execute('UPDATE cache_size SET bytes = bytes + ? WHERE id = 0', (added_bytes,))
+                self.total_bytes = self.read_total_bytes()
+                if self.total_bytes > self.max_bytes:
+                    self.evict(int(self.max_bytes * 0.9))
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+
+    # Called inside put_many's write transaction
+    def evict(self, target_bytes):
+        evicted_keys = []
+        evicted_bytes = 0
+        for key, size in self.connection.execute('SELECT key, size FROM embeddings ORDER BY last_used'):
+            if self.total_bytes - evicted_bytes <= target_bytes:
+                break
+            evicted_keys.append((key,))
+            evicted_bytes += size
+        self.connection.executemany('DELETE FROM embeddings WHERE key = ?', evicted_keys)
+        self.connection.execute('UPDATE cache_size SET bytes = bytes - ? WHERE id = 0', (evicted_bytes,))
+        self.total_bytes -= evicted_bytes
+        self.evictions += len(evicted_keys)
+
+    def stats(self):
+        with self.lock:
+            self.total_bytes = self.read_total_bytes()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'bytes': self.total_bytes}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def create_embedding_backend(name, api_key=None):
+    if name == 'openai':
+        return OpenAIEmbedder(api_key=api_key)
+    if name == 'fake':
+        return FakeEmbedder()
+    raise ValueError(f'Unknown embeddings backend: {name}')
+
+
+# Rough token count (about 4 characters per token for English text), used for rate limiting
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    # Thread-safe token bucket refilled continuously at rate_per_minute
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Empties the bucket for `seconds` so every worker backs off after a rate-limit response
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+def is_rate_limit_error(error):
+    status_code = getattr(error, 'status_code', None)
+    return status_code == 429 or type(error).__name__ == 'RateLimitError'
+
+
+# Timeouts, dropped connections and server-side errors usually succeed when sent again, unlike invalid requests
+transient_status_codes = {408, 409, 500, 502, 503, 504}
+transient_error_names = {'APITimeoutError', 'APIConnectionError', 'InternalServerError'}
+
+
+def is_transient_error(error):
+    if is_rate_limit_error(error) or isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return getattr(error, 'status_code', None) in transient_status_codes or type(error).__name__ in transient_error_names
+
+
+def retry_after_seconds(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class BatchEmbedder:
+    # Embeds many texts by packing them into requests of at most batch_size texts / max_batch_tokens
+    # estimated tokens, sending up to max_workers requests at once while staying within the
+    # requests-per-minute and tokens-per-minute budgets. Rate-limited requests and transient failures
+    # (timeouts, connection errors, 5xx) are retried with exponential backoff; texts whose request still
+    # fails get None and are counted as embedding_failed_texts. With a cache, only the texts it does not
+    # already hold are sent.
+    def __init__(self, backend, batch_size=100, max_batch_tokens=200000, max_workers=4,
+                 requests_per_minute=3000, tokens_per_minute=1000000, max_retries=6, max_backoff=60.0, cache=None):
+        self.backend = backend
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_workers = max_workers
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+
+    def make_batches(self, texts):
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for index, text in enumerate(texts):
+            tokens = estimate_tokens(text)
+            if batch and (len(batch) >= self.batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                batches.append((batch, batch_tokens))
+                batch = []
+                batch_tokens = 0
+            batch.append(index)
+            batch_tokens += tokens
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    def embed_batch(self, texts, model, batch_tokens):
+        for attempt in range(self.max_retries + 1):
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(batch_tokens)
+            start = time.perf_counter()
+            try:
+                vectors = self.backend.embed(texts, model)
+                metrics.observe('embedding_request_latency', time.perf_counter() - start)
+                metrics.count('embedding_requests')
+                metrics.count('embedded_texts', len(texts))
+                return vectors
+            except Exception as e:
+                metrics.observe('embedding_request_latency', time.perf_counter() - start)
+                rate_limited = is_rate_limit_error(e)
+                if rate_limited:
+                    metrics.count('embedding_rate_limited')
+                if not is_transient_error(e) or attempt == self.max_retries:
+                    print(f"Failed to get embeddings for a batch of {len(texts)}: {e}")
+                    metrics.count('embedding_failed_texts', len(texts))
+                    return [None] * len(texts)
+                metrics.count('embedding_retries')
+                backoff = retry_after_seconds(e) or min(self.max_backoff, 2 ** attempt) * random.uniform(0.5, 1.0)
+                if rate_limited:
+                    self.request_bucket.pause(backoff)
+                time.sleep(backoff)
+
+    def embed_all(self, texts, model):
+        if self.cache is None:
+            return self.embed_uncached(texts, model)
+
+        vectors = self.cache.get_many(texts, model)
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        if missing:
+            missing_texts = [texts[index] for index in missing]
+            missing_vectors = self.embed_uncached(missing_texts, model)
+            self.cache.put_many(missing_texts, missing_vectors, model)
+            for index, vector in zip(missing, missing_vectors):
+                vectors[index] = vector
+        return vectors
+
+    def embed_uncached(self, texts, model):
+        vectors = [None] * len(texts)
+        batches = self.make_batches(texts)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                (indexes, executor.submit(self.embed_batch, [texts[index] for index in indexes], model, batch_tokens))
+                for indexes, batch_tokens in batches
+            ]
+            for indexes, future in futures:
+                for index, vector in zip(indexes, future.result()):
+                    vectors[index] = vector
+        return vectors
@@ -0,0 +1,154 @@
+import mmap
+import os
+import struct
+from array import array
+from fhir_codec import NDJSONWriter, loads, open_file, seek_forward
+
+# Output formats for the enriched resources written by Stage 3 and read by Stage 4.
+#
+# Enriched resources are NDJSON, optionally gzip or zstd compressed (output_format 'ndjson', 'ndjson.gz' or
+# 'ndjson.zst'). With vector side-files enabled, embedding vectors are not written as JSON floats but appended
+# as packed float32 rows to <ResourceType>.vectors.f32, and the resource keeps only the row number
+# (metadata.vectorSearchEmbeddings.vectorIndex). Readers memory-map the side-file and restore "vector".
+
+output_formats = ('ndjson', 'ndjson.gz', 'ndjson.zst')
+vector_file_suffix = '.vectors.f32'
+
+VECTOR_MAGIC = b'F32VEC01'
+VECTOR_HEADER_FORMAT = '<8sI'
+VECTOR_HEADER_SIZE = struct.calcsize(VECTOR_HEADER_FORMAT)
+
+
+def enriched_file_name(resource_type, output_format='ndjson'):
+    if output_format not in output_formats:
+        raise ValueError(f'Unknown output format: {output_format}')
+    return f'{resource_type}.{output_format}'
+
+
+# Returns the collection (resource type) name for an enriched file name, or None for other files
+def enriched_collection_name(filename):
+    for output_format in output_formats:
+        if filename.endswith('.' + output_format):
+            return filename[:-len(output_format) - 1]
+    return None
+
+
+def vector_file_path(folder_path, resource_type):
+    return os.path.join(folder_path, resource_type + vector_file_suffix)
+
+
+class VectorFileWriter:
+    # Appends vectors of one fixed size as float32 rows; the size is taken from the first vector
+    def __init__(self, file_path):
+        self.file = open(file_path, 'wb')
+        self.dimensions = None
+        self.count = 0
+
+    def append(self, vector):
+        if self.dimensions is None:
+            self.dimensions = len(vector)
+            self.file.write(struct.pack(VECTOR_HEADER_FORMAT, VECTOR_MAGIC, self.dimensions))
+        elif len(vector) != self.dimensions:
+            raise ValueError(f'Expected a vector of {self.dimensions} dimensions, got {len(vector)}')
+        self.file.write(array('f', vector).tobytes())
+        self.count += 1
+        return self.count - 1
+
+    def close(self):
+        self.file.close()
+
+
+class VectorFile:
+    # Memory-mapped reader for a VectorFileWriter file
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.dimensions = struct.unpack_from(VECTOR_HEADER_FORMAT, self.buffer, 0)
+        if magic != VECTOR_MAGIC:
+            raise ValueError(f'{file_path} is not a vector file')
+        self.row_size = 4 * self.dimensions
+        self.count = (len(self.buffer) - VECTOR_HEADER_SIZE) // self.row_size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        start = VECTOR_HEADER_SIZE + index * self.row_size
+        return array('f', self.buffer[start:start + self.row_size]).tolist()
+
+    def close(self):
+        self.buffer.close()
+
+
+class EnrichedResourceWriter:
+    # Writes the enriched resources of one resource type in the chosen format
+    def __init__(self, folder_path, resource_type, output_format='ndjson', vector_side_file=False):
+        self.file_path = os.path.join(folder_path, enriched_file_name(resource_type, output_format))
+        self.writer = NDJSONWriter(self.file_path)
+        self.vector_file_path = vector_file_path(folder_path, resource_type)
+        self.vectors = None
+        self.vector_side_file = vector_side_file
+        # Uncompressed bytes of the resources and vectors, known once the writer is closed
+        self.bytes_written = 0
+
+    def write(self, enriched_resource):
+        embedding = enriched_resource["metadata"].get("vectorSearchEmbeddings")
+        if self.vector_side_file and embedding is not None and embedding.get("vector") is not None:
+            if self.vectors is None:
+                self.vectors = VectorFileWriter(self.vector_file_path)
+            embedding = dict(embedding)
+            embedding["vectorIndex"] = self.vectors.append(embedding.pop("vector"))
+            enriched_resource = dict(enriched_resource, metadata=dict(enriched_resource["metadata"], vectorSearchEmbeddings=embedding))
+        self.writer.write(enriched_resource)
+
+    def close(self):
+        self.writer.close()
+        self.bytes_written = self.writer.bytes_written
+        if self.vectors is not None:
+            self.bytes_written += self.vectors.file.tell()
+            self.vectors.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_vector_file(folder_path, resource_type):
+    file_path = vector_file_path(folder_path, resource_type)
+    return VectorFile(file_path) if os.path.exists(file_path) else None
+
+
+# Puts the vector back into a resource written with a vector side-file
+def restore_vector(enriched_resource, vectors):
+    embedding = enriched_resource.get("metadata", {}).get("vectorSearchEmbeddings")
+    if embedding is not None and "vectorIndex" in embedding:
+        embedding["vector"] = vectors[embedding.pop("vectorIndex")] if vectors is not None else None
+    return enriched_resource
+
+
+# Reads enriched resources in any output format, restoring side-file vectors. Yields (resource, end_offset)
+# where end_offset is the offset in the uncompressed stream just after the resource's line.
+def iter_enriched(folder_path, filename, start_offset=0):
+    resource_type = enriched_collection_name(filename)
+    vectors = open_vector_file(folder_path, resource_type)
+    offset = start_offset
+    try:
+        with open_file(os.path.join(folder_path, filename), 'rb') as file:
+            seek_forward(file, start_offset)
+            for line in file:
+                offset += len(line)
+                if line.strip():
+                    yield restore_vector(loads(line), vectors), offset
+    finally:
+        if vectors is not None:
+            vectors.close()
+
+
+def remove_enriched_files(folder_path):
+    for filename in os.listdir(folder_path):
+        if enriched_collection_name(filename) is not None or filename.endswith(vector_file_suffix):
+            os.remove(os.path.join(folder_path, filename))
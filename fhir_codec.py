@@ -0,0 +1,148 @@
+import gzip
+import io
+import json
+import os
+
+# Shared JSON codec for all stages. Uses orjson or msgspec when one is installed and falls back to the
+# standard library json module otherwise. Set FHIR_JSON_BACKEND to orjson, msgspec or json to force one.
+#
+# dumps() always returns compact UTF-8 bytes, whatever the backend, and NDJSONWriter buffers those bytes
+# so each output file is written in large chunks instead of one write call per resource.
+#
+# Files ending in .gz or .zst are compressed and decompressed transparently (.zst needs the zstandard package).
+
+
+class JSONBackend:
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+def _orjson_backend():
+    import orjson
+    return JSONBackend('orjson', orjson.loads, orjson.dumps)
+
+
+def _msgspec_backend():
+    import msgspec
+    encoder = msgspec.json.Encoder()
+    decoder = msgspec.json.Decoder()
+    return JSONBackend('msgspec', decoder.decode, encoder.encode)
+
+
+def _json_backend():
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    return JSONBackend('json', json.loads, lambda obj: encoder.encode(obj).encode('utf-8'))
+
+
+backend_factories = {
+    'orjson': _orjson_backend,
+    'msgspec': _msgspec_backend,
+    'json': _json_backend,
+}
+
+
+def available_backends():
+    names = []
+    for name, factory in backend_factories.items():
+        try:
+            factory()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def get_backend(name='auto'):
+    if name != 'auto':
+        return backend_factories[name]()
+    for factory in backend_factories.values():
+        try:
+            return factory()
+        except ImportError:
+            continue
+
+
+backend = get_backend(os.getenv('FHIR_JSON_BACKEND', 'auto'))
+loads = backend.loads
+dumps = backend.dumps
+
+
+# Opens a file in binary mode ('rb', 'wb' or 'ab'), compressing or decompressing by extension
+def open_file(file_path, mode='rb'):
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, mode, compresslevel=6)
+    if file_path.endswith('.zst'):
+        import zstandard
+        raw_file = open(file_path, mode)
+        if mode == 'rb':
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw_file, closefd=True))
+        return zstandard.ZstdCompressor(level=3).stream_writer(raw_file, closefd=True)
+    return open(file_path, mode)
+
+
+# Moves a file opened by open_file to an offset of its uncompressed content; streams that can't seek
+# (zstd) are read forward instead
+def seek_forward(file, offset):
+    if file.seekable():
+        file.seek(offset)
+        return
+    while offset > 0:
+        chunk = file.read(min(offset, 1024 * 1024))
+        if not chunk:
+            break
+        offset -= len(chunk)
+
+
+def load_file(file_path):
+    with open_file(file_path, 'rb') as file:
+        return loads(file.read())
+
+
+def iter_ndjson(file_path):
+    with open_file(file_path, 'rb') as file:
+        for line in file:
+            if line.strip():
+                yield loads(line)
+
+
+class NDJSONWriter:
+    # Buffers serialized lines and writes them to the file in chunks of about buffer_size bytes
+    def __init__(self, file_path, mode='wb', buffer_size=1024 * 1024):
+        self.file = open_file(file_path, mode)
+        self.buffer_size = buffer_size
+        self.pending = []
+        self.pending_size = 0
+        # Uncompressed bytes handed to the file so far
+        self.bytes_written = 0
+
+    def write(self, obj):
+        self.write_line(dumps(obj))
+
+    def write_line(self, line):
+        # line is already-serialized JSON (bytes, without the trailing newline)
+        self.pending.append(line)
+        self.pending_size += len(line) + 1
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.pending.append(b'')
+            data = b'\n'.join(self.pending)
+            self.file.write(data)
+            self.bytes_written += len(data)
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,257 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Timers, counters and latency histograms shared by every stage, and a JSON report written at the end of a run.
+#
+#   with run_stage('stage2-update-references'):
+#       ...
+#       with metrics.timer('parse'):
+#           ...
+#       metrics.count('resources')
+#       metrics.observe('mongo_batch_latency', seconds)
+#
+# Set PIPELINE_QUIET=1 to replace the per-file messages with a progress line every progress_interval seconds,
+# and PIPELINE_PROFILE=cprofile (or pyinstrument, when installed) to profile the whole run.
+# Reports and profiles are saved in Dataset/reports.
+
+reports_folder_path = os.path.join('Dataset', 'reports')
+quiet = os.getenv('PIPELINE_QUIET', '') not in ('', '0')
+profiler_name = os.getenv('PIPELINE_PROFILE', '')
+progress_interval = 10.0
+
+# Upper bounds (in seconds) of the latency histogram buckets
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(latency_buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(latency_buckets) and seconds > latency_buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    # Approximate quantile: the upper bound of the bucket holding it
+    def quantile(self, fraction):
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return latency_buckets[index] if index < len(latency_buckets) else self.max
+        return None
+
+    def merge(self, other):
+        for index, count in enumerate(other['buckets'].values()):
+            self.counts[index] += count
+        self.count += other['count']
+        self.total += other['sum']
+        for name, pick in (('min', min), ('max', max)):
+            if other[name] is not None:
+                current = getattr(self, name)
+                setattr(self, name, other[name] if current is None else pick(current, other[name]))
+
+    def to_dict(self):
+        bounds = [str(bound) for bound in latency_buckets] + ['+Inf']
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip(bounds, self.counts)),
+        }
+
+
+class StageMetrics:
+    # Thread-safe, so the Stage 3 embedding threads and the Stage 4 upload threads can record into it
+    def __init__(self, stage='pipeline'):
+        self.lock = threading.Lock()
+        self.reset(stage)
+
+    def reset(self, stage=None):
+        with self.lock:
+            self.stage = stage or self.stage
+            self.started = time.perf_counter()
+            self.started_at = datetime.now()
+            self.last_progress = self.started
+            self.timers = {}  # name -> [seconds, calls]
+            self.counters = {}
+            self.histograms = {}
+            self.error = None
+            self.report_path = None
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += calls
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    # Per-item message: printed unless running quietly
+    def log(self, message):
+        if not quiet:
+            print(message)
+
+    # Counts one finished item; in quiet mode prints a progress line every progress_interval seconds
+    def progress(self, name, total=None, amount=1):
+        self.count(name, amount)
+        if not quiet:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            if now - self.last_progress < progress_interval:
+                return
+            self.last_progress = now
+            done = self.counters[name]
+        elapsed = now - self.started
+        of_total = f'/{total}' if total is not None else ''
+        print(f'[{self.stage}] {done}{of_total} {name} in {elapsed:.0f}s ({done / elapsed:,.1f}/s)')
+
+    # Plain-dict copy of the measurements, e.g. to send them back from a worker process
+    def snapshot(self):
+        with self.lock:
+            return {
+                'timers': {name: list(timer) for name, timer in self.timers.items()},
+                'counters': dict(self.counters),
+                'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            }
+
+    # Adds the snapshot of a worker to these measurements
+    def merge(self, snapshot):
+        for name, (seconds, calls) in snapshot['timers'].items():
+            self.add_time(name, seconds, calls)
+        for name, amount in snapshot['counters'].items():
+            self.count(name, amount)
+        with self.lock:
+            for name, histogram in snapshot['histograms'].items():
+                self.histograms.setdefault(name, Histogram()).merge(histogram)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        snapshot = self.snapshot()
+        return {
+            'stage': self.stage,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'elapsed_seconds': elapsed,
+            'timers': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in snapshot['timers'].items()},
+            'counters': snapshot['counters'],
+            'throughput_per_second': {name: amount / elapsed for name, amount in snapshot['counters'].items()} if elapsed > 0 else {},
+            'histograms': snapshot['histograms'],
+            'peak_rss_bytes': peak_rss_bytes(),
+            'error': self.error,
+        }
+
+    def write_report(self, file_path=None):
+        file_path = file_path or os.path.join(reports_folder_path, f"{self.stage}-{self.started_at:%Y%m%d-%H%M%S}.json")
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        with open(file_path, 'w', encoding='utf-8') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+        print(f'Run report saved in {file_path}')
+        self.report_path = file_path
+        return file_path
+
+
+# Peak resident set size of this process and of its finished worker processes, or None where unavailable
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return {'process': own, 'largest_worker': children}
+
+
+# The measurements of the running stage. Worker processes get their own copy: they reset it at the start
+# of each task and return metrics.snapshot(), which the parent merges.
+metrics = StageMetrics()
+
+
+@contextmanager
+def profiled(file_stem):
+    if profiler_name == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(file_stem + '.prof')
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(20)
+            print(summary.getvalue())
+            print(f'Profile saved in {file_stem}.prof')
+    elif profiler_name == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(file_stem + '.html', 'w', encoding='utf-8') as profile_file:
+                profile_file.write(profiler.output_html())
+            print(f'Profile saved in {file_stem}.html')
+    else:
+        yield
+
+
+# Measures a whole stage run: resets the metrics, optionally profiles, and writes the report at the end
+# (also when the run fails, with the error recorded)
+@contextmanager
+def run_stage(stage):
+    metrics.reset(stage)
+    os.makedirs(reports_folder_path, exist_ok=True)
+    file_stem = os.path.join(reports_folder_path, f'{stage}-{metrics.started_at:%Y%m%d-%H%M%S}')
+    try:
+        with profiled(file_stem):
+            yield metrics
+    except BaseException as e:
+        metrics.error = repr(e)
+        raise
+    finally:
+        metrics.write_report(file_stem + '.json')
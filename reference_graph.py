@@ -0,0 +1,326 @@
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from uuid_mapping_store import RecordKeys, split_url
+
+# Compact indexes over the rewritten resources, built by Stage 1 and Stage 2.
+#
+# patient_index.bin (Stage 1) maps every resource to the patient of the bundle it came from. Stage 1 hands out
+# IDs bundle by bundle, so each bundle owns one contiguous counter range per resource type, and the index is one
+# record per (bundle, resource type):
+#   header                  PATIENT_INDEX_MAGIC + record_count, types_size
+#   resource types          UTF-8, newline separated, indexed by position
+#   range records           type index + first + last + patient counter, sorted by (type, first)
+#   patient records         patient counter + type index + first + last, sorted by patient
+# so "which patient owns Observation/12" and "all resources of Patient/3" are each one binary search.
+#
+# reference_graph.bin (Stage 2) holds every resolved reference as an edge (source, field, target), where field is
+# the path of the reference element without list positions, e.g. "subject" or "participant.individual":
+#   header                  REFERENCE_GRAPH_MAGIC + edge_count, types_size, fields_size
+#   resource types, fields  UTF-8, newline separated, indexed by position
+#   forward records         source type + counter, field index, target type + counter, sorted
+#   reverse records         target type + counter, field index, source type + counter, sorted
+#
+# Records are packed big-endian so byte order equals sort order, and lookups search the memory-mapped file.
+# A patient counter of 0 means the bundle had no Patient resource.
+
+PATIENT_INDEX_MAGIC = b'PATIDX01'
+PATIENT_INDEX_HEADER_FORMAT = '<8sII'
+PATIENT_INDEX_HEADER_SIZE = struct.calcsize(PATIENT_INDEX_HEADER_FORMAT)
+RANGE_RECORD = struct.Struct('>HIII')
+PATIENT_RECORD = struct.Struct('>IHII')
+
+REFERENCE_GRAPH_MAGIC = b'REFGRPH1'
+REFERENCE_GRAPH_HEADER_FORMAT = '<8sIII'
+REFERENCE_GRAPH_HEADER_SIZE = struct.calcsize(REFERENCE_GRAPH_HEADER_FORMAT)
+EDGE_RECORD = struct.Struct('>HIHHI')
+
+
+def patient_counter(patient_id):
+    url_parts = split_url(patient_id) if patient_id else None
+    return url_parts[1] if url_parts and url_parts[0] == 'Patient' else 0
+
+
+# Returns {resource_type: (first, last)} for the counters a bundle advanced
+def bundle_ranges(counters_before, counters_after):
+    return {
+        resource_type: (counters_before.get(resource_type, 0) + 1, counter)
+        for resource_type, counter in counters_after.items()
+        if counter != counters_before.get(resource_type, 0)
+    }
+
+
+def write_types_blob(types):
+    if len(types) > 0xFFFF:
+        raise ValueError('Too many resource types for the index')
+    return '\n'.join(types).encode('utf-8')
+
+
+def read_types_blob(buffer, offset, size):
+    blob = buffer[offset:offset + size].decode('utf-8')
+    return blob.split('\n') if blob else []
+
+
+# bundles: [(patient_id or None, {resource_type: (first, last)}), ...] in bundle order
+def write_patient_index(file_path, bundles):
+    types = {}
+    records = []
+    for patient_id, ranges in bundles:
+        patient = patient_counter(patient_id)
+        for resource_type, (first, last) in ranges.items():
+            records.append((types.setdefault(resource_type, len(types)), first, last, patient))
+    types_blob = write_types_blob(types)
+
+    temp_file_path = file_path + '.tmp'
+    with open(temp_file_path, 'wb') as file:
+        file.write(struct.pack(PATIENT_INDEX_HEADER_FORMAT, PATIENT_INDEX_MAGIC, len(records), len(types_blob)))
+        file.write(types_blob)
+        records.sort()
+        file.write(b''.join(RANGE_RECORD.pack(*record) for record in records))
+        patient_records = sorted((patient, type_index, first, last) for type_index, first, last, patient in records)
+        file.write(b''.join(PATIENT_RECORD.pack(*record) for record in patient_records))
+    os.replace(temp_file_path, file_path)
+
+
+class PatientIndex:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, types_size = struct.unpack_from(PATIENT_INDEX_HEADER_FORMAT, self.buffer, 0)
+        if magic != PATIENT_INDEX_MAGIC:
+            raise ValueError(f'{file_path} is not a patient index')
+        self.types = read_types_blob(self.buffer, PATIENT_INDEX_HEADER_SIZE, types_size)
+        self.type_indexes = {resource_type: index for index, resource_type in enumerate(self.types)}
+        self.range_offset = PATIENT_INDEX_HEADER_SIZE + types_size
+        self.patient_offset = self.range_offset + self.count * RANGE_RECORD.size
+        self.range_keys = RecordKeys(self.buffer, self.range_offset, self.count, RANGE_RECORD.size, 6)
+        self.patient_keys = RecordKeys(self.buffer, self.patient_offset, self.count, PATIENT_RECORD.size, 4)
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        return {'file_path': self.file_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['file_path'])
+
+    # Returns the patient counter of the bundle a resource ID came from (0 for a bundle without a Patient),
+    # or None when no bundle of the index handed out that ID
+    def find_bundle_patient(self, resource_id):
+        url_parts = split_url(resource_id) if isinstance(resource_id, str) else None
+        type_index = self.type_indexes.get(url_parts[0]) if url_parts else None
+        if type_index is None:
+            return None
+        # The last range starting at or before the counter is the only one that can hold it
+        index = bisect_right(self.range_keys, struct.pack('>HI', type_index, url_parts[1])) - 1
+        if index < 0:
+            return None
+        record_type, first, last, patient = RANGE_RECORD.unpack_from(self.buffer, self.range_offset + index * RANGE_RECORD.size)
+        if record_type != type_index or not first <= url_parts[1] <= last:
+            return None
+        return patient
+
+    def contains(self, resource_id):
+        return self.find_bundle_patient(resource_id) is not None
+
+    # Returns the patient ID ("Patient/3") of the bundle a resource ID came from, or None. Ownership is bundle
+    # membership: the copies of an Organization or Practitioner that Synthea repeats in every bundle are owned by
+    # that bundle's patient.
+    def patient_of(self, resource_id):
+        patient = self.find_bundle_patient(resource_id)
+        return f'Patient/{patient}' if patient else None
+
+    # Returns {resource_type: [(first, last), ...]} for a patient ID
+    def ranges_for_patient(self, patient_id):
+        patient = patient_counter(patient_id)
+        ranges = {}
+        if not patient:
+            return ranges
+        key = struct.pack('>I', patient)
+        index = bisect_left(self.patient_keys, key)
+        while index < self.count and self.patient_keys[index] == key:
+            _, type_index, first, last = PATIENT_RECORD.unpack_from(self.buffer, self.patient_offset + index * PATIENT_RECORD.size)
+            ranges.setdefault(self.types[type_index], []).append((first, last))
+            index += 1
+        return ranges
+
+    def resources_for_patient(self, patient_id):
+        return [f'{resource_type}/{counter}'
+                for resource_type, ranges in self.ranges_for_patient(patient_id).items()
+                for first, last in ranges
+                for counter in range(first, last + 1)]
+
+
+def open_patient_index(file_path):
+    return PatientIndex(file_path)
+
+
+# Stable across runs and machines (unlike hash()), so a patient always lands in the same shard
+def shard_for_patient(patient_id, shard_count):
+    return zlib.crc32(patient_id.encode('utf-8')) % shard_count
+
+
+class EdgeCollector:
+    # Collects the references of rewritten resources as edges grouped by (source type, field, target type),
+    # each group an array of (source counter, target counter) pairs, so worker processes can send them back cheaply
+    def __init__(self):
+        self.groups = {}
+        self.unresolved = 0
+
+    def add_resource(self, resource):
+        source = split_url(resource.get('id', '')) if isinstance(resource.get('id'), str) else None
+        if source is None:
+            return
+        stack = [(resource, '')]
+        while stack:
+            node, path = stack.pop()
+            if type(node) is list:
+                stack.extend((item, path) for item in node if type(item) is dict or type(item) is list)
+                continue
+            for key, value in node.items():
+                if key == 'reference':
+                    if path and type(value) is str:
+                        self.add(source, path, value)
+                elif type(value) is dict or type(value) is list:
+                    stack.append((value, f'{path}.{key}' if path else key))
+
+    def add(self, source, field, target_id):
+        target = split_url(target_id)
+        if target is None:
+            # Still a urn:uuid (not in the mapping) or a conditional reference such as "Practitioner?identifier=..."
+            self.unresolved += 1
+            return
+        group = self.groups.get((source[0], field, target[0]))
+        if group is None:
+            group = self.groups[(source[0], field, target[0])] = array('I')
+        group.append(source[1])
+        group.append(target[1])
+
+    def merge(self, groups, unresolved=0):
+        for group_key, pairs in groups.items():
+            if group_key in self.groups:
+                self.groups[group_key].extend(pairs)
+            else:
+                self.groups[group_key] = array('I', pairs)
+        self.unresolved += unresolved
+
+    def edge_count(self):
+        return sum(len(pairs) // 2 for pairs in self.groups.values())
+
+    def write(self, file_path):
+        types = {}
+        fields = {}
+        forward_records = []
+        for (source_type, field, target_type), pairs in self.groups.items():
+            source_index = types.setdefault(source_type, len(types))
+            target_index = types.setdefault(target_type, len(types))
+            field_index = fields.setdefault(field, len(fields))
+            for position in range(0, len(pairs), 2):
+                forward_records.append((source_index, pairs[position], field_index, target_index, pairs[position + 1]))
+        if len(fields) > 0xFFFF:
+            raise ValueError('Too many reference fields for the index')
+        types_blob = write_types_blob(types)
+        fields_blob = '\n'.join(fields).encode('utf-8')
+
+        temp_file_path = file_path + '.tmp'
+        with open(temp_file_path, 'wb') as file:
+            file.write(struct.pack(REFERENCE_GRAPH_HEADER_FORMAT, REFERENCE_GRAPH_MAGIC, len(forward_records), len(types_blob), len(fields_blob)))
+            file.write(types_blob)
+            file.write(fields_blob)
+            forward_records.sort()
+            file.write(b''.join(EDGE_RECORD.pack(*record) for record in forward_records))
+            reverse_records = sorted((target_index, target, field_index, source_index, source)
+                                     for source_index, source, field_index, target_index, target in forward_records)
+            file.write(b''.join(EDGE_RECORD.pack(*record) for record in reverse_records))
+        os.replace(temp_file_path, file_path)
+
+
+class ReferenceGraph:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, types_size, fields_size = struct.unpack_from(REFERENCE_GRAPH_HEADER_FORMAT, self.buffer, 0)
+        if magic != REFERENCE_GRAPH_MAGIC:
+            raise ValueError(f'{file_path} is not a reference graph')
+        offset = REFERENCE_GRAPH_HEADER_SIZE
+        self.types = read_types_blob(self.buffer, offset, types_size)
+        self.type_indexes = {resource_type: index for index, resource_type in enumerate(self.types)}
+        offset += types_size
+        self.fields = read_types_blob(self.buffer, offset, fields_size)
+        offset += fields_size
+        self.forward_offset = offset
+        self.reverse_offset = offset + self.count * EDGE_RECORD.size
+        self.forward_keys = RecordKeys(self.buffer, self.forward_offset, self.count, EDGE_RECORD.size, 6)
+        self.reverse_keys = RecordKeys(self.buffer, self.reverse_offset, self.count, EDGE_RECORD.size, 6)
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        return {'file_path': self.file_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['file_path'])
+
+    def edges(self, keys, records_offset, resource_id, field):
+        url_parts = split_url(resource_id) if isinstance(resource_id, str) else None
+        type_index = self.type_indexes.get(url_parts[0]) if url_parts else None
+        if type_index is None:
+            return []
+        key = struct.pack('>HI', type_index, url_parts[1])
+        index = bisect_left(keys, key)
+        edges = []
+        while index < self.count and keys[index] == key:
+            _, _, field_index, other_type, other = EDGE_RECORD.unpack_from(self.buffer, records_offset + index * EDGE_RECORD.size)
+            if field is None or self.fields[field_index] == field:
+                edges.append((self.fields[field_index], f'{self.types[other_type]}/{other}'))
+            index += 1
+        return edges
+
+    # Returns [(field, target ID), ...] for the references held by a resource
+    def references_from(self, resource_id, field=None):
+        return self.edges(self.forward_keys, self.forward_offset, resource_id, field)
+
+    # Returns [(field, source ID), ...] for the resources referencing a resource
+    def referenced_by(self, resource_id, field=None):
+        return self.edges(self.reverse_keys, self.reverse_offset, resource_id, field)
+
+
+def open_reference_graph(file_path):
+    return ReferenceGraph(file_path)
+
+
+# Usage: python reference_graph.py <patient_index.bin> <Patient/ID>            lists the patient's resources
+#        python reference_graph.py <reference_graph.bin> <Type/ID>            lists a resource's references both ways
+if __name__ == "__main__":
+    with open(sys.argv[1], 'rb') as index_file:
+        magic = index_file.read(8)
+    if magic == PATIENT_INDEX_MAGIC:
+        with open_patient_index(sys.argv[1]) as patient_index:
+            for resource_id in patient_index.resources_for_patient(sys.argv[2]):
+                print(resource_id)
+    else:
+        with open_reference_graph(sys.argv[1]) as reference_graph:
+            for field, target_id in reference_graph.references_from(sys.argv[2]):
+                print(f'{sys.argv[2]} --{field}--> {target_id}')
+            for field, source_id in reference_graph.referenced_by(sys.argv[2]):
+                print(f'{source_id} --{field}--> {sys.argv[2]}')
@@ -0,0 +1,164 @@
+# Resource-type configuration shared by Stage 3 (enrichment) and Stage 4 (index provisioning).
+
+# Define search parameters for each resource type (simplified for demonstration)
+search_parameters_config = {
+"AllergyIntolerance": [
+    {"key": "patient", "attribute": "patient.reference"},
+    {"key": "clinical-status", "attribute": "clinicalStatus.coding[0].code"},
+    {"key": "verification-status", "attribute": "verificationStatus.coding[0].code"},
+    {"key": "code", "attribute": "code.coding[0].code"},
+    {"key": "onset", "attribute": "onsetDateTime"}
+],
+"CarePlan": [
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "date", "attribute": "period.start"},
+    {"key": "category", "attribute": "category[0].coding[0].code"},
+    {"key": "status", "attribute": "status"}
+],
+"CareTeam": [
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "status", "attribute": "status"},
+    {"key": "encounter", "attribute": "encounter.reference"},
+    {"key": "participant", "attribute": "participant.member.reference"}
+],
+"Condition": [
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "clinical-status", "attribute": "clinicalStatus.coding[0].code"},
+    {"key": "code", "attribute": "code.coding[0].code"},
+    {"key": "onset-date", "attribute": "onsetDateTime"}
+],
+"Device": [
+    {"key": "patient", "attribute": "patient.reference"},
+    {"key": "status", "attribute": "status"},
+    {"key": "type", "attribute": "type.coding[0].code"},
+    {"key": "identifier", "attribute": "identifier[0].value"}
+],
+"DiagnosticReport": [
+    {"key": "basedOn", "attribute": "basedOn.reference"},
+    {"key": "category", "attribute": "category.coding[0].code"},
+    {"key": "code", "attribute": "code.coding[0].code"},
+    {"key": "conclusion", "attribute": "conclusion"},
+    {"key": "date", "attribute": "effectiveDateTime"},
+    {"key": "encounter", "attribute": "encounter.reference"},
+    {"key": "identifier", "attribute": "identifier[0].value"},
+    {"key": "issued", "attribute": "issued"},
+    {"key": "media", "attribute": "media[0].link"},
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "performer", "attribute": "performer[0].actor.reference"},
+    {"key": "result", "attribute": "result[0].reference"},
+    {"key": "resultsInterpreter", "attribute": "resultsInterpreter[0].reference"},
+    {"key": "specimen", "attribute": "specimen[0].reference"},
+    {"key": "status", "attribute": "status"},
+    {"key": "study", "attribute": "imagingStudy[0].reference"},
+    {"key": "subject", "attribute": "subject.reference"}
+],
+"DocumentReference": [
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "type", "attribute": "type.coding[0].code"},
+    {"key": "date", "attribute": "date"},
+    {"key": "category", "attribute": "category[0].coding[0].code"}
+],
+"Encounter": [
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "date", "attribute": "period.start"},
+    {"key": "type", "attribute": "type[0].coding[0].code"},
+    {"key": "status", "attribute": "status"}
+],
+"ImagingStudy": [
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "modality", "attribute": "series[0].modality.code"},
+    {"key": "date", "attribute": "started"},
+    {"key": "basedon", "attribute": "basedOn[0].reference"}
+],
+"Immunization": [
+    {"key": "patient", "attribute": "patient.reference"},
+    {"key": "date", "attribute": "occurrenceDateTime"},
+    {"key": "status", "attribute": "status"},
+    {"key": "vaccine-code", "attribute": "vaccineCode.coding[0].code"}
+],
+"Location": [
+    {"key": "name", "attribute": "name"},
+    {"key": "address", "attribute": "address.text"},
+    {"key": "type", "attribute": "type[0].coding[0].code"},
+    {"key": "status", "attribute": "status"}
+],
+"Medication": [
+    {"key": "code", "attribute": "code.coding[0].code"},
+    {"key": "status", "attribute": "status"},
+    {"key": "form", "attribute": "form.coding[0].code"},
+    {"key": "ingredient", "attribute": "ingredient[0].itemCodeableConcept.coding[0].code"}
+],
+"MedicationAdministration": [
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "status", "attribute": "status"},
+    {"key": "effective-time", "attribute": "effectiveDateTime"},
+    {"key": "medication", "attribute": "medicationCodeableConcept.coding[0].code"}
+],
+"MedicationRequest": [
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "status", "attribute": "status"},
+    {"key": "intent", "attribute": "intent"},
+    {"key": "medication", "attribute": "medicationCodeableConcept.coding[0].code"}
+],
+"MedicationStatement": [
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "status", "attribute": "status"},
+    {"key": "effective", "attribute": "effectiveDateTime"},
+    {"key": "medication", "attribute": "medicationCodeableConcept.coding[0].code"}
+],
+"Observation": [
+    {"key": "subject", "attribute": "subject.reference"},
+    {"key": "code", "attribute": "code.coding[0].code"},
+    {"key": "date", "attribute": "effectiveDateTime"},
+    {"key": "status", "attribute": "status"}
+],
+"Organization": [
+    {"key": "name", "attribute": "name"},
+    {"key": "active", "attribute": "active"},
+    {"key": "type", "attribute": "type[0].coding[0].code"},
+    {"key": "address", "attribute": "address[0].text"}
+],
+"Patient": [
+    {"key": "identifier", "attribute": "identifier[0].value"},
+    {"key": "name", "attribute": "name[0].family"},
+    {"key": "family", "attribute": "name[0].family"},
+    {"key": "given", "attribute": "name[0].given[0]"},
+    {"key": "gender", "attribute": "gender"},
+    {"key": "birthdate", "attribute": "birthDate"},
+    {"key": "address", "attribute": "address[0].line[0]"},
+    {"key": "address-city", "attribute": "address[0].city"},
+    {"key": "address-state", "attribute": "address[0].state"},
+    {"key": "address-postalcode", "attribute": "address[0].postalCode"},
+    {"key": "phone", "attribute": "telecom[0].value"},
+    {"key": "email", "attribute": "telecom[1].value"},
+    {"key": "deceased", "attribute": "deceasedBoolean"},
+    {"key": "language", "attribute": "communication[0].language.coding[0].code"}
+],
+"Practitioner": [
+    {"key": "name", "attribute": "name[0].family"},
+    {"key": "identifier", "attribute": "identifier[0].value"},
+    {"key": "address", "attribute": "address[0].line[0]"},
+    {"key": "gender", "attribute": "gender"}
+],
+"PractitionerRole": [
+    {"key": "practitioner", "attribute": "practitioner.reference"},
+    {"key": "organization", "attribute": "organization.reference"},
+    {"key": "role", "attribute": "code[0].coding[0].code"},
+    {"key": "service", "attribute": "healthcareService[0].reference"}
+],
+"Procedure": [
+    {"key": "patient", "attribute": "subject.reference"},
+    {"key": "date", "attribute": "performedDateTime"},
+    {"key": "status", "attribute": "status"},
+    {"key": "code", "attribute": "code.coding[0].code"}
+]
+}
+
+# Add embeddings configuration according to your needs. In this current conf only DiagnosticReport generates them)
+embeddings_config = {
+    "DiagnosticReport": {
+        "path": "presentedForm[].data",
+        "encodedBase64": True,
+        "model": "text-embedding-3-small"
+    },
+}
@@ -0,0 +1,44 @@
+import importlib
+import importlib.abc
+import importlib.util
+import os
+import sys
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The Stage scripts have hyphenated file names, so they can't be imported with a plain import statement.
+# load_stage loads one of them as a module (their work only runs under __main__, so importing is side-effect free
+# apart from creating the output folders).
+#
+# The modules are registered as submodules of this one, e.g. stage_modules.Stage1_splitBundlesAndMappingNewReferences,
+# and found again by StageFinder. Functions of a loaded stage sent to a process pool pickle under that name, so
+# child processes started with spawn or forkserver (which import them by name instead of inheriting them) can
+# import them too: importing the parent stage_modules installs the finder first.
+__path__ = []
+
+
+def stage_script_name(module_name):
+    for script_name in os.listdir(repo_dir):
+        if script_name.endswith('.py') and os.path.splitext(script_name)[0].replace('-', '_') == module_name:
+            return script_name
+    return None
+
+
+class StageFinder(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        package, _, module_name = fullname.rpartition('.')
+        if package != __name__:
+            return None
+        script_name = stage_script_name(module_name)
+        if script_name is None:
+            return None
+        return importlib.util.spec_from_file_location(fullname, os.path.join(repo_dir, script_name))
+
+
+if not any(isinstance(finder, StageFinder) for finder in sys.meta_path):
+    sys.meta_path.append(StageFinder())
+
+
+def load_stage(script_name):
+    module_name = os.path.splitext(script_name)[0].replace('-', '_')
+    return importlib.import_module(f'{__name__}.{module_name}')
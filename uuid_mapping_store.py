@@ -0,0 +1,222 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import uuid
+from bisect import bisect_left
+
+# Compact on-disk store for the uuid_to_url_mapping produced by Stage 1.
+#
+# Layout (all counts little-endian):
+#   header                  MAGIC + record_count, types_size, extras_size
+#   resource types          UTF-8, newline separated, indexed by position
+#   extras                  JSON object for the rare entries that are not "urn:uuid:<uuid>" -> "<Type>/<int>"
+#   forward records         16-byte UUID + type index + counter, sorted by UUID
+#   reverse records         type index + counter + 16-byte UUID, sorted by (type, counter)
+#
+# Both record arrays are packed big-endian so byte order equals sort order, and both directions are
+# answered by a binary search over the memory-mapped file instead of loading a dict.
+
+MAGIC = b'UUIDMAP1'
+HEADER_FORMAT = '<8sIII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+FORWARD_RECORD = struct.Struct('>16sHI')
+REVERSE_RECORD = struct.Struct('>HI16s')
+URN_PREFIX = 'urn:uuid:'
+
+
+# Returns the 16 UUID bytes of a canonical "urn:uuid:<lowercase uuid>" reference, or None
+def pack_uuid_reference(reference):
+    if len(reference) != 45 or not reference.startswith(URN_PREFIX):
+        return None
+    value = reference[9:]
+    if value != value.lower() or value[8] != '-' or value[13] != '-' or value[18] != '-' or value[23] != '-':
+        return None
+    try:
+        return bytes.fromhex(value.replace('-', ''))
+    except ValueError:
+        return None
+
+
+def unpack_uuid_reference(uuid_bytes):
+    return URN_PREFIX + str(uuid.UUID(bytes=uuid_bytes))
+
+
+# Returns (resource_type, counter) for a "<Type>/<int>" URL, or None
+def split_url(url):
+    resource_type, _, counter = url.rpartition('/')
+    if not resource_type or not counter.isdigit() or str(int(counter)) != counter or int(counter) > 0xFFFFFFFF:
+        return None
+    return resource_type, int(counter)
+
+
+def write_mapping(file_path, uuid_to_url_mapping):
+    types = {}
+    forward_records = []
+    extras = {}
+    for reference, url in uuid_to_url_mapping.items():
+        uuid_bytes = pack_uuid_reference(reference)
+        url_parts = split_url(url)
+        if uuid_bytes is None or url_parts is None or '\n' in url_parts[0]:
+            extras[reference] = url
+            continue
+        type_index = types.setdefault(url_parts[0], len(types))
+        forward_records.append((uuid_bytes, type_index, url_parts[1]))
+
+    if len(types) > 0xFFFF:
+        raise ValueError('Too many resource types for the mapping store')
+
+    types_blob = '\n'.join(types).encode('utf-8')
+    extras_blob = json.dumps(extras).encode('utf-8')
+
+    temp_file_path = file_path + '.tmp'
+    with open(temp_file_path, 'wb') as file:
+        file.write(struct.pack(HEADER_FORMAT, MAGIC, len(forward_records), len(types_blob), len(extras_blob)))
+        file.write(types_blob)
+        file.write(extras_blob)
+        forward_records.sort()
+        file.write(b''.join(FORWARD_RECORD.pack(*record) for record in forward_records))
+        reverse_records = sorted((type_index, counter, uuid_bytes) for uuid_bytes, type_index, counter in forward_records)
+        file.write(b''.join(REVERSE_RECORD.pack(*record) for record in reverse_records))
+    os.replace(temp_file_path, file_path)
+
+
+# Sequence view over the keys of a packed record array, so the C bisect can search the mmap directly
+class RecordKeys:
+    def __init__(self, buffer, offset, count, record_size, key_size):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+        self.record_size = record_size
+        self.key_size = key_size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        start = self.offset + index * self.record_size
+        return self.buffer[start:start + self.key_size]
+
+
+class UuidMappingStore:
+    # Read-only, dict-like view of the mapping in the UUID -> URL direction
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, types_size, extras_size = struct.unpack_from(HEADER_FORMAT, self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{file_path} is not a UUID mapping store')
+
+        offset = HEADER_SIZE
+        types_blob = self.buffer[offset:offset + types_size].decode('utf-8')
+        self.types = types_blob.split('\n') if types_blob else []
+        self.type_indexes = {resource_type: index for index, resource_type in enumerate(self.types)}
+        offset += types_size
+        self.extras = json.loads(self.buffer[offset:offset + extras_size])
+        self.reversed_extras = {url: reference for reference, url in self.extras.items()}
+        offset += extras_size
+
+        self.forward_offset = offset
+        self.reverse_offset = offset + self.count * FORWARD_RECORD.size
+        self.forward_keys = RecordKeys(self.buffer, self.forward_offset, self.count, FORWARD_RECORD.size, 16)
+        self.reverse_keys = RecordKeys(self.buffer, self.reverse_offset, self.count, REVERSE_RECORD.size, 6)
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        # Worker processes reopen the file instead of pickling the mapped pages
+        return {'file_path': self.file_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['file_path'])
+
+    def __len__(self):
+        return self.count + len(self.extras)
+
+    def lookup_url(self, reference):
+        uuid_bytes = pack_uuid_reference(reference)
+        if uuid_bytes is None:
+            return self.extras.get(reference)
+        index = bisect_left(self.forward_keys, uuid_bytes)
+        if index < self.count and self.forward_keys[index] == uuid_bytes:
+            _, type_index, counter = FORWARD_RECORD.unpack_from(self.buffer, self.forward_offset + index * FORWARD_RECORD.size)
+            return f'{self.types[type_index]}/{counter}'
+        return self.extras.get(reference)
+
+    def lookup_uuid(self, url):
+        url_parts = split_url(url) if isinstance(url, str) else None
+        type_index = self.type_indexes.get(url_parts[0]) if url_parts else None
+        if type_index is None:
+            return self.reversed_extras.get(url)
+        key = struct.pack('>HI', type_index, url_parts[1])
+        index = bisect_left(self.reverse_keys, key)
+        if index < self.count and self.reverse_keys[index] == key:
+            start = self.reverse_offset + index * REVERSE_RECORD.size + 6
+            return unpack_uuid_reference(self.buffer[start:start + 16])
+        return self.reversed_extras.get(url)
+
+    def get(self, reference, default=None):
+        url = self.lookup_url(reference)
+        return default if url is None else url
+
+    def __contains__(self, reference):
+        return self.lookup_url(reference) is not None
+
+    def __getitem__(self, reference):
+        url = self.lookup_url(reference)
+        if url is None:
+            raise KeyError(reference)
+        return url
+
+    def items(self):
+        for index in range(self.count):
+            uuid_bytes, type_index, counter = FORWARD_RECORD.unpack_from(self.buffer, self.forward_offset + index * FORWARD_RECORD.size)
+            yield unpack_uuid_reference(uuid_bytes), f'{self.types[type_index]}/{counter}'
+        yield from self.extras.items()
+
+    def reversed(self):
+        return ReversedUuidMapping(self)
+
+
+class ReversedUuidMapping:
+    # Dict-like view of the same store in the URL -> UUID direction
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, url, default=None):
+        reference = self.store.lookup_uuid(url)
+        return default if reference is None else reference
+
+    def __contains__(self, url):
+        return self.store.lookup_uuid(url) is not None
+
+    def __getitem__(self, url):
+        reference = self.store.lookup_uuid(url)
+        if reference is None:
+            raise KeyError(url)
+        return reference
+
+
+def open_mapping(file_path):
+    return UuidMappingStore(file_path)
+
+
+# Usage: python uuid_mapping_store.py <mapping.bin>            prints the mapping as JSON
+#        python uuid_mapping_store.py <mapping.json> <out.bin>  converts an old JSON mapping
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        with open(sys.argv[1], 'r', encoding='utf-8') as mapping_file:
+            write_mapping(sys.argv[2], json.load(mapping_file))
+    else:
+        with open_mapping(sys.argv[1]) as store:
+            json.dump(dict(store.items()), sys.stdout, indent=2)